@@ -0,0 +1,110 @@
+####################################################################################
+#                          The MIT License (MIT)                                   #
+#                                                                                  #
+# Copyright (c) 2014 Wouter van Atteveldt                                          #
+#                                                                                  #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of  #
+# this software and associated documentation files (the "Software"), to deal in    #
+# the Software without restriction, including without limitation the rights to     #
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of #
+# the Software, and to permit persons to whom the Software is furnished to do so,  #
+# subject to the following conditions:                                             #
+#                                                                                  #
+# The above copyright notice and this permission notice shall be included in all   #
+# copies or substantial portions of the Software.                                  #
+#                                                                                  #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR       #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS #
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR   #
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER   #
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN          #
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.       #
+####################################################################################
+
+"""
+Stand-in for bin/Alpino and Tokenization/tok, for benchmarks and tests without Alpino.
+
+make_alpino_home creates an ALPINO_HOME with bin/Alpino and Tokenization/tok
+scripts that call the functions below:
+
+- tok: puts each sentence on its own line and separates punctuation
+- Alpino: reads 'key|sentence' lines and writes dependency triples for each sentence,
+  using the recorded output in fixtures/alpino_triples.txt for known sentences and
+  a synthetic (flat) analysis otherwise. If ALPINO_FAKE_DELAY is set, sleeps that
+  many seconds times the squared sentence length to mimic Alpino's parse time.
+"""
+
+import os
+import re
+import sys
+import time
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "alpino_triples.txt")
+
+def read_fixtures(fn=FIXTURES):
+    """Return a dict of sentence : [triple lines without key]"""
+    fixtures, sentence = {}, None
+    for line in open(fn):
+        line = line.rstrip("\n")
+        if line.startswith("#S "):
+            sentence = line[3:]
+            fixtures[sentence] = []
+        elif line and not line.startswith("#"):
+            fixtures[sentence].append(line.rsplit("|", 1)[0])
+    return fixtures
+
+def synthetic_triples(tokens):
+    """Attach all tokens to the first token as a flat analysis"""
+    head = [tokens[0].lower(), tokens[0], "0", "1", "verb", "verb(hebben,sg3,transitive)", "verb(hebben,sg3,transitive)"]
+    for i, token in enumerate(tokens[1:], 1):
+        if re.match(r"^\W+$", token):
+            rel, dep = "--/punct", ["punct", "punct(punt)", "punct(punt)"]
+        else:
+            rel, dep = "hd/mod", ["noun", "noun(de,count,sg)", "noun(de,count,sg)"]
+        yield "|".join(head + [rel, token.lower(), token, str(i), str(i+1)] + dep)
+
+def alpino(stdin, stdout):
+    fixtures = read_fixtures()
+    delay = float(os.environ.get("ALPINO_FAKE_DELAY", 0))
+    for line in iter(stdin.readline, ""):
+        if "|" not in line:
+            continue
+        key, sentence = line.rstrip("\n").split("|", 1)
+        tokens = sentence.split()
+        if not tokens:
+            continue
+        if delay:
+            time.sleep(delay * len(tokens) ** 2)
+        triples = fixtures.get(" ".join(tokens)) or synthetic_triples(tokens)
+        for triple in triples:
+            stdout.write("{triple}|{key}\n".format(**locals()))
+        stdout.flush()
+
+def tok(stdin, stdout):
+    for line in stdin:
+        line = re.sub(r"(\w)([.,!?;:])", r"\1 \2", line.strip())
+        for sentence in re.split(r"(?<=[.!?]) +", line):
+            if sentence.strip():
+                stdout.write(sentence.strip() + "\n")
+
+SCRIPT = """#!{python}
+import sys
+sys.path.insert(0, {root!r})
+from amcatxtas.benchmarks import fake_alpino
+fake_alpino.{function}(sys.stdin, sys.stdout)
+"""
+
+def make_alpino_home(path):
+    """Create an ALPINO_HOME in path with scripts that call alpino and tok as bin/Alpino and Tokenization/tok"""
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    for name, function in ("bin/Alpino", "alpino"), ("Tokenization/tok", "tok"):
+        fn = os.path.join(path, name)
+        if not os.path.exists(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        with open(fn, "w") as f:
+            f.write(SCRIPT.format(python=sys.executable, **locals()))
+        os.chmod(fn, 0755)
+    return path
+
+if __name__ == '__main__':
+    make_alpino_home(sys.argv[1])
@@ -0,0 +1,158 @@
+####################################################################################
+#                          The MIT License (MIT)                                   #
+#                                                                                  #
+# Copyright (c) 2014 Wouter van Atteveldt                                          #
+#                                                                                  #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of  #
+# this software and associated documentation files (the "Software"), to deal in    #
+# the Software without restriction, including without limitation the rights to     #
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of #
+# the Software, and to permit persons to whom the Software is furnished to do so,  #
+# subject to the following conditions:                                             #
+#                                                                                  #
+# The above copyright notice and this permission notice shall be included in all   #
+# copies or substantial portions of the Software.                                  #
+#                                                                                  #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR       #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS #
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR   #
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER   #
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN          #
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.       #
+####################################################################################
+
+"""
+Benchmark the parsing, interpretation and serialization hot paths.
+
+Synthetic articles of several sizes are built from the recorded sentences in
+fixtures/alpino_triples.txt and generated sentences, and each stage is timed
+separately using a fake Alpino (see fake_alpino.py). Every measurement runs in a
+fresh child process, which also reports the increase in peak memory (max RSS).
+Results are written as json, and two result files can be compared with --compare.
+"""
+
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import multiprocessing
+from StringIO import StringIO
+
+from amcatxtas.plugins import alpino
+from amcatxtas.tools import naf, naf_binary
+from amcatxtas.benchmarks import fake_alpino
+
+SIZES = [1, 10, 100, 1000] # sentences per article
+WORDS = ["de", "het", "een", "kat", "hond", "Jan", "Marie", "ziet", "loopt", "gisteren", "snel",
+         "naar", "huis", "boek", "leest", "mooie", "grote", "stad", "in", "met"]
+
+def make_text(n_sentences, seed=1):
+    """Return a text of n sentences, mixing recorded fixture sentences and generated sentences"""
+    rnd = random.Random(seed)
+    fixtures = sorted(fake_alpino.read_fixtures())
+    sentences = []
+    for i in range(n_sentences):
+        if i % 3 == 0:
+            sentences.append(fixtures[i % len(fixtures)])
+        else:
+            words = [rnd.choice(WORDS) for j in range(rnd.randint(5, 30))]
+            sentences.append(" ".join(words).capitalize() + " .")
+    return "\n\n".join(sentences)
+
+def get_stages(text):
+    """Return a list of (stage, setup, function) triples, where function is called with the result of setup"""
+    tokens = lambda: alpino.tokenize(text)
+    output = lambda: "".join(alpino.get_pool().lines(
+        [(i, s) for (i, s) in enumerate(tokens().split("\n"), 1) if s.strip()]))
+    article = lambda: alpino.interpret_parse(output())
+    return [
+        ("tok", lambda: text, alpino.tokenize),
+        ("alpino", tokens, alpino.parse),
+        ("interpret_parse", output, alpino.interpret_parse),
+        ("serialize", article, alpino.AlpinoPlugin.serialize),
+        ("to_json", article, lambda a: a.to_json()),
+        ("from_json", lambda: article().to_json(), naf.NAF_Article.from_json),
+        ("binary_encode", article, naf_binary.encode),
+        ("binary_decode", lambda: naf_binary.encode(article()), naf_binary.decode),
+        ("generate_xml", article, lambda a: a.generate_xml()),
+        ("write_xml", article, lambda a: a.write_xml(StringIO())),
+        ]
+
+def _measure(setup, function, repeat, conn):
+    """Run in a child process: time function(setup()) repeat times and measure the peak memory increase"""
+    try:
+        arg = setup()
+        times = []
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        for i in range(repeat):
+            start = time.time()
+            function(arg)
+            times.append(time.time() - start)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+        conn.send({"min" : min(times), "median" : sorted(times)[len(times) // 2], "max_rss_kb" : rss})
+    except Exception as e:
+        conn.send({"error" : repr(e)})
+
+def measure(setup, function, repeat):
+    parent, child = multiprocessing.Pipe()
+    p = multiprocessing.Process(target=_measure, args=(setup, function, repeat, child))
+    p.start()
+    result = parent.recv()
+    p.join()
+    return result
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(__file__)).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(sizes=SIZES, repeat=5, stages=None):
+    alpino.ALPINO_HOME = fake_alpino.make_alpino_home(tempfile.mkdtemp())
+    results = []
+    for size in sizes:
+        text = make_text(size)
+        for stage, setup, function in get_stages(text):
+            if stages and stage not in stages:
+                continue
+            result = measure(setup, function, repeat)
+            result.update(stage=stage, sentences=size)
+            sys.stderr.write("{stage:16s} {size:6d} sentences: {result}\n".format(**locals()))
+            results.append(result)
+    return {"commit" : get_commit(), "python" : platform.python_version(), "platform" : platform.platform(),
+            "time" : time.strftime("%Y-%m-%dT%H:%M:%S"), "repeat" : repeat, "results" : results}
+
+def compare(old, new):
+    """Yield stage, sentences, old, new, ratio tuples for the min timings in two result dicts"""
+    old = {(r["stage"], r["sentences"]) : r for r in old["results"] if "min" in r}
+    for r in new["results"]:
+        key = (r["stage"], r["sentences"])
+        if key in old and "min" in r:
+            yield key + (old[key]["min"], r["min"], r["min"] / old[key]["min"] if old[key]["min"] else None)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--sizes', type=lambda s: [int(x) for x in s.split(",")], default=SIZES,
+                        help="Comma separated article sizes in sentences")
+    parser.add_argument('--repeat', '-r', type=int, default=5)
+    parser.add_argument('--stage', action='append', help="Only run this stage (can be repeated)")
+    parser.add_argument('--output', '-o', help="Write results to this file instead of stdout")
+    parser.add_argument('--compare', nargs=2, metavar=("OLD", "NEW"), help="Compare two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        old, new = [json.load(open(fn)) for fn in args.compare]
+        for stage, size, t_old, t_new, ratio in compare(old, new):
+            print "{stage:16s} {size:6d} {t_old:10.5f} {t_new:10.5f} {ratio:6.2f}".format(**locals())
+    else:
+        result = json.dumps(run(args.sizes, args.repeat, args.stage), indent=2)
+        if args.output:
+            open(args.output, "w").write(result)
+        else:
+            print result
@@ -1,18 +1,77 @@
-import threading, subprocess, logging
+import os, threading, subprocess, logging, Queue, time, atexit, itertools, collections
+from contextlib import contextmanager
 from ..tools import naf
+from ..tools.cache import cache_key, SQLiteCache
+from ..tools.metrics import metrics
 log = logging.getLogger(__name__)
 
-ALPINO_HOME="/home/wva/Alpino"
+ALPINO_HOME=os.environ.get("ALPINO_HOME", "/home/wva/Alpino")
 ALPINO = ["bin/Alpino","end_hook=dependencies","-parse"]
 TOK = ["Tokenization/tok"]
 
+# settings for the pool of long running Alpino processes
+ALPINO_POOL_SIZE = int(os.environ.get("ALPINO_POOL_SIZE", 1))
+ALPINO_TIMEOUT = float(os.environ.get("ALPINO_TIMEOUT", 600))
+# time budget per sentence, passed to Alpino as user_max. Workers that do not produce any output
+# for twice this time are considered stuck and restarted
+ALPINO_SENTENCE_TIMEOUT = float(os.environ.get("ALPINO_SENTENCE_TIMEOUT", 60))
+# time budget per article, remaining sentences of an article that exceeds it are not parsed
+ALPINO_ARTICLE_TIMEOUT = float(os.environ.get("ALPINO_ARTICLE_TIMEOUT", 1800))
+# sentence that is parsed after each request to mark the end of its output
+ALPINO_MARKER = "het einde"
+ALPINO_MARKER_KEY = "marker"
+
+# sentences longer than ALPINO_LONG_SENTENCE tokens are parsed one by one in a separate pool,
+# with ALPINO_LONG_TIMEOUT as request and sentence timeout.
+# Other sentences are parsed in batches of about ALPINO_BATCH_TOKENS tokens
+ALPINO_LONG_SENTENCE = int(os.environ.get("ALPINO_LONG_SENTENCE", 80))
+ALPINO_LONG_POOL_SIZE = int(os.environ.get("ALPINO_LONG_POOL_SIZE", 1))
+ALPINO_LONG_TIMEOUT = float(os.environ.get("ALPINO_LONG_TIMEOUT", 1800))
+ALPINO_BATCH_TOKENS = int(os.environ.get("ALPINO_BATCH_TOKENS", 500))
+
+# sqlite file to cache the Alpino output per sentence, if given
+ALPINO_SENTENCE_CACHE = os.environ.get("ALPINO_SENTENCE_CACHE")
+
 class AlpinoPlugin(object):
     xtas_key = ("parse", "alpino")
+    version = 2 # increase when the output changes, to invalidate cached results
+    
+    sentence_cache = None # cache of the Alpino output per sentence, see get_sentence_cache
+    tokenizer = "amcatxtas.plugins.alpino.tokenize" # shared with other plugins that use the Alpino tokens
     
     @classmethod
     def process(cls, text):
-        tokens = tokenize(text)
-        return parse(tokens)
+        article, = cls.process_batch([text])
+        if isinstance(article, Exception):
+            raise article
+        return article
+
+    @classmethod
+    def process_batch(cls, texts):
+        """Process the texts as one workload (see parse_batch), returning an article or exception per text"""
+        tokens = []
+        for text in texts:
+            try:
+                tokens.append(tokenize(text))
+            except EnvironmentError:
+                raise # e.g. tok could not be started, which is not a problem of this text
+            except Exception as e:
+                log.exception("Error on tokenizing text")
+                tokens.append(e)
+        articles = iter(cls.process_tokens([t for t in tokens if not isinstance(t, Exception)]))
+        return [t if isinstance(t, Exception) else next(articles) for t in tokens]
+
+    @classmethod
+    def process_tokens(cls, token_texts):
+        """Process texts that were already tokenized by the tokenizer"""
+        return parse_batch(token_texts, cls.get_sentence_cache())
+
+    @classmethod
+    def get_sentence_cache(cls):
+        """Return the sentence cache, opening ALPINO_SENTENCE_CACHE on first use (i.e. in the worker process)"""
+        if cls.sentence_cache is None and ALPINO_SENTENCE_CACHE:
+            cls.sentence_cache = SQLiteCache(ALPINO_SENTENCE_CACHE)
+        return cls.sentence_cache
 
     @classmethod
     def serialize(cls, naf):
@@ -29,47 +88,493 @@ class AlpinoPlugin(object):
 def tokenize(text):
     if isinstance(text, unicode): text=text.encode("utf-8")
 
-    p = subprocess.Popen(TOK, shell=False, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=ALPINO_HOME)
-    tokens, err = p.communicate(text)
-    tokens = tokens.replace("|", "") # alpino interprets 'sid | line' as sid indicator
+    with metrics.timer("tok") as t:
+        p = subprocess.Popen(TOK, shell=False, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=ALPINO_HOME)
+        tokens, err = p.communicate(text)
+        tokens = tokens.replace("|", "") # alpino interprets 'sid | line' as sid indicator
+        t["tokens"] = len(tokens.split())
     return tokens
 
-def parse(tokens):
-    p = subprocess.Popen(ALPINO, shell=False, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                         cwd=ALPINO_HOME, env={'ALPINO_HOME': ALPINO_HOME})
-    parse, err = p.communicate(tokens)
+def parse(tokens, cache=None):
+    """
+    Parse the tokens (see parse_batch), raising the exception if the text could not be parsed.
+    If a cache is given, only sentences that are not in the cache are sent to Alpino.
+    The cache stores the output lines of each (whitespace normalized) sentence without
+    sentence id, so sentence, word and term ids are numbered as if the whole text was parsed.
+    """
+    article, = parse_batch([tokens], cache)
+    if isinstance(article, Exception):
+        raise article
+    return article
+
+def parse_batch(token_texts, cache=None):
+    """
+    Parse the tokenized texts, returning a NAF_Article for each text, or the exception if it failed.
+    The sentences of all texts are parsed as one workload: long sentences are parsed one by one
+    in the long sentence pool, and the others are grouped into batches of similar length that are
+    divided over all workers of the pool, so a long article does not hold up a worker on its own.
+    Sentences that cannot be parsed within their budget (see BatchParser) or interpreted are added
+    with only their tokens, with the error in the 'error' attribute of the terms.
+    If a cache is given, only sentences that are not in the cache are parsed (see parse).
+    Sentences are numbered by their line in the tokens, as Alpino does when parsing a whole text.
+    Each sentence is interpreted as soon as its output is read, so the output lines are not kept.
+    """
+    texts = [[(sid, " ".join(s.split())) for (sid, s) in enumerate(tokens.split("\n"), 1) if s.strip()]
+             for tokens in token_texts]
+    sentences = [(sid, s) for text in texts for (sid, s) in text]
+    if cache is not None:
+        keys = [cache_key(s, AlpinoPlugin, "sentence") for (sid, s) in sentences]
+        output = [cache.get(key) for key in keys]
+    else:
+        output = [None] * len(sentences)
+    todo = [(i, s) for (i, (sid, s)) in enumerate(sentences, 1) if output[i-1] is None]
+    articles = {i : a for (i, a) in enumerate((a for (a, text) in enumerate(texts) for s in text), 1)}
+
+    def interpret(i, lines):
+        if cache is not None:
+            cache.set(keys[i-1], lines)
+        return interpret_part(sentences[i-1][0], sentences[i-1][1], lines)
+
+    parser = BatchParser(articles, ALPINO_ARTICLE_TIMEOUT, interpret)
+    if todo:
+        log.debug("Parsing {n} of {m} sentences".format(n=len(todo), m=len(sentences)))
+        long_batches = [[(i, s)] for (i, s) in todo if len(s.split()) > ALPINO_LONG_SENTENCE]
+        short = [(i, s) for (i, s) in todo if len(s.split()) <= ALPINO_LONG_SENTENCE]
+        with metrics.timer("alpino", tokens=sum(len(s.split()) for (i, s) in todo)):
+            if long_batches:
+                parser.start(get_long_pool(), long_batches)
+            if short:
+                parser.start(get_pool(), make_batches(short))
+            parser.join()
+        metrics.count("sentences_long", len(long_batches))
+    metrics.count("sentences_cached", len(sentences) - len(todo))
+    metrics.count("sentences_parsed", len(todo))
+
+    results, offset = [], 0
+    for text in texts:
+        with metrics.timer("interpret") as t:
+            article = naf.NAF_Article()
+            for i, (sid, sentence) in enumerate(text, offset + 1):
+                error = parser.errors.get(i)
+                if error is not None:
+                    metrics.fail("alpino", error)
+                else:
+                    if output[i-1] is not None: # cached
+                        part = interpret_part(sid, sentence, output[i-1])
+                    elif i in parser.output: # interpreted while parsing
+                        part = parser.output[i]
+                    else: # no output at all
+                        part = interpret(i, [])
+                    if isinstance(part, Exception):
+                        error = part
+                    else:
+                        add_sentences(article, part)
+                if error is not None:
+                    add_tokens(article, sid, sentence, error)
+                    metrics.count("sentences_failed")
+            t["tokens"] = len(article.words)
+        offset += len(text)
+        results.append(article)
+    return results
+
+def interpret_part(sid, sentence, lines):
+    """Interpret the Alpino output lines of a sentence as a separate NAF_Article, returning the exception if it fails"""
+    part = naf.NAF_Article()
     try:
-        return interpret_parse(parse)
-    except:
-        import tempfile
-        h, fnt = tempfile.mkstemp()
-        open(fnt, 'w').write(tokens)
-        h, fnp = tempfile.mkstemp()
-        open(fnp, 'w').write(parse)
+        interpret_sentence(part, sid, lines)
+    except Exception as e:
+        log.exception("Error on interpreting parse of sentence {sid}: {sentence!r}".format(**locals()))
+        metrics.fail("interpret", e)
+        return e
+    return part
+
+def add_sentences(article, part):
+    """Add the sentences, words, terms and dependencies of part (see interpret_part) to the article, renumbering their ids"""
+    nwords, nterms = len(article.words), len(article.terms)
+    terms = [t._replace(term_id=t.term_id + nterms, word_ids=[w + nwords for w in t.word_ids]) for t in part.terms]
+    article.words.extend(w._replace(word_id=w.word_id + nwords) for w in part.words)
+    article.terms.extend(terms)
+    article.dependencies.extend(d._replace(from_term=d.from_term + nterms, to_term=d.to_term + nterms)
+                                for d in part.dependencies)
+    for sentence in part.sentences:
+        sentence.article = article
+        sentence.terms = [terms[t.term_id - 1] for t in sentence.terms]
+        sentence.__dict__.pop("terms_by_offset", None)
+        article.sentences.append(sentence)
 
-        log.exception("Error on interpreting parse! Parse written to {fnp}, tokens to {fnt}".format(**locals()))
+def interpret_sentence(article, sid, lines):
+    """
+    Add the sentence with the given Alpino output lines (without sentence id) to the article.
+    If a line cannot be interpreted, the words, terms and dependencies of the sentence that
+    were already added are removed before raising the exception.
+    """
+    if not lines:
+        return
+    sizes = [(attr, len(getattr(article, attr))) for attr in ("words", "terms", "dependencies")]
+    sentence = article.create_sentence(sentence_id=sid)
+    sentence.terms_by_offset = {}
+    try:
+        for line in lines:
+            interpret_line(sentence, line.strip().split("|") + [str(sid)])
+    except:
+        for attr, n in sizes:
+            del getattr(article, attr)[n:]
+        article.sentences.remove(sentence)
         raise
-    
+
+def add_tokens(article, sid, sentence, error):
+    """Add the tokens of a sentence that could not be parsed as words and terms, marking the terms with the error"""
+    error = "{}: {}".format(type(error).__name__, error)
+    s = article.create_sentence(sentence_id=sid)
+    for offset, word in enumerate(sentence.split()):
+        s.add_word(offset, word, word, "?", term_extra={"error" : error})
+
+def make_batches(sentences, batch_tokens=None):
+    """
+    Group the (key, sentence) pairs into batches of at most batch_tokens tokens (or a single longer
+    sentence). Sentences are sorted by length, longest first, so batches contain sentences of
+    similar length and the slowest batches are started first.
+    """
+    batch_tokens = ALPINO_BATCH_TOKENS if batch_tokens is None else batch_tokens
+    batches, batch, size = [], [], 0
+    for key, sentence in sorted(sentences, key=lambda (key, sentence): len(sentence.split()), reverse=True):
+        n = len(sentence.split())
+        if batch and size + n > batch_tokens:
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append((key, sentence))
+        size += n
+    if batch:
+        batches.append(batch)
+    return batches
+
+class BatchParser(object):
+    """
+    Parse batches of (key, sentence) pairs on the workers of one or more pools, collecting the
+    output lines per key in .output, and the exception for sentences that failed in .errors.
+    If interpret is given, it is called with the key and output lines of each sentence as soon as
+    its output is complete, and its result is kept in .output instead of the lines.
+    If a batch fails, the sentences of which no (complete) output was read are retried one by
+    one, so only the sentence that caused the failure fails.
+    Parse time is counted per article (given as a dict key : article), and sentences of articles
+    that used more than budget seconds are not parsed.
+    """
+    def __init__(self, articles, budget=None, interpret=None):
+        self.articles = articles
+        self.budget = budget
+        self.interpret = interpret
+        self.output = {}
+        self.errors = {}
+        self.spent = collections.defaultdict(float)
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def start(self, pool, batches):
+        """Start a thread for each worker in the pool that parses batches until all are done"""
+        todo = Queue.Queue()
+        for batch in batches:
+            todo.put(batch)
+        for i in range(min(pool.size, len(batches))):
+            thread = threading.Thread(target=self._run, args=(pool, todo))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def _run(self, pool, todo):
+        while True:
+            try:
+                batch = todo.get_nowait()
+            except Queue.Empty:
+                return
+            for key, sentence in batch:
+                if self.budget is not None and self.spent[self.articles[key]] > self.budget:
+                    self.errors[key] = AlpinoTimeout("Article exceeded its budget of {self.budget} seconds".format(**locals()))
+            batch = [(key, sentence) for (key, sentence) in batch if key not in self.errors]
+            if not batch:
+                continue
+            seen = []
+            try:
+                self._parse(pool, batch, seen)
+            except Exception as e:
+                if len(batch) == 1:
+                    log.warn("Could not parse sentence {}: {!r}".format(batch[0][0], e))
+                    self.errors[batch[0][0]] = e
+                    continue
+                log.warn("Error on parsing batch of {n} sentences, retrying sentences one by one: {e!r}"
+                         .format(n=len(batch), **locals()))
+                # output of the last sentence that was seen may be incomplete, so it was not kept
+                done = set(seen[:-1])
+                for key, sentence in batch:
+                    if key not in done:
+                        todo.put([(key, sentence)])
+
+    def _parse(self, pool, batch, seen):
+        """Parse the batch, adding the keys to seen as their output is read"""
+        last = time.time()
+        lines = [] # output of the current sentence
+        try:
+            for line in pool.lines(batch):
+                line, key = line.rstrip("\n").rsplit("|", 1)
+                key = int(key)
+                if not seen or seen[-1] != key:
+                    # the output of the previous sentence is complete, as alpino parses sentences in order
+                    if seen:
+                        self._finish(seen[-1], lines)
+                        lines = []
+                    # so the time since the last output was spent on this sentence
+                    last = self._spend(key, last)
+                    seen.append(key)
+                lines.append(line)
+            if seen:
+                self._finish(seen[-1], lines)
+        except:
+            # count the time until the error for the next sentence, which is probably the cause
+            keys = [key for (key, sentence) in batch]
+            following = keys[keys.index(seen[-1])+1:] if seen else keys
+            if following:
+                self._spend(following[0], last)
+            raise
+
+    def _finish(self, key, lines):
+        self.output[key] = lines if self.interpret is None else self.interpret(key, lines)
+
+    def _spend(self, key, since):
+        now = time.time()
+        with self.lock:
+            self.spent[self.articles[key]] += now - since
+        return now
+
+class AlpinoError(Exception):
+    pass
+
+class AlpinoTimeout(AlpinoError):
+    pass
+
+def _read_lines(stream, queue):
+    """Copy lines from stream to queue, adding None when the stream is closed"""
+    try:
+        for line in iter(stream.readline, ""):
+            queue.put(line)
+    except (IOError, ValueError):
+        pass # stream closed by stop
+    queue.put(None)
+
+def _write(stream, data):
+    try:
+        stream.write(data)
+        stream.flush()
+    except IOError:
+        pass # process died, will be noticed by the reader
+
+class AlpinoWorker(object):
+    """
+    A long running Alpino process. Sentences are written to its stdin as 'key|sentence' lines,
+    followed by a marker sentence with a unique key, so all output up to the marker
+    output belongs to the request. Output is read in a separate thread so we can time out.
+    """
+    def __init__(self, timeout=None, sentence_timeout=None):
+        self.timeout = ALPINO_TIMEOUT if timeout is None else timeout
+        self.sentence_timeout = ALPINO_SENTENCE_TIMEOUT if sentence_timeout is None else sentence_timeout
+        self.process = None
+        self.reader = None
+        self.markers = itertools.count()
+        self.start()
+
+    def start(self):
+        user_max = "user_max={}".format(int(self.sentence_timeout * 1000))
+        self.process = subprocess.Popen(ALPINO[:1] + [user_max] + ALPINO[1:], shell=False, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        cwd=ALPINO_HOME, env={'ALPINO_HOME': ALPINO_HOME})
+        self.output = Queue.Queue()
+        self.reader = threading.Thread(target=_read_lines, args=(self.process.stdout, self.output))
+        self.reader.daemon = True
+        self.reader.start()
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        if self.reader is not None:
+            # the reader stops at the end of the output, wait for it so it does not outlive the interpreter
+            self.reader.join(5)
+            for stream in self.process.stdin, self.process.stdout:
+                try:
+                    stream.close()
+                except IOError:
+                    pass # broken pipe, or still in use by a reader that did not stop
+        self.process, self.reader = None, None
+
+    def restart(self):
+        log.warn("Restarting Alpino worker")
+        self.stop()
+        self.start()
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def check(self):
+        """Check that the process is alive and responds to a (marker-only) request"""
+        try:
+            for line in self.lines([]):
+                pass
+        except AlpinoError:
+            return False
+        return True
+
+    def lines(self, sentences):
+        """
+        Parse the (key, sentence) pairs and yield the output lines as they arrive.
+        Raises AlpinoTimeout if the request is not finished within the timeout, or if there is no
+        output for twice the sentence timeout (Alpino should give up on a sentence after the
+        sentence timeout itself, so it is probably stuck). If an error occurs,
+        or the generator is not exhausted, the worker should be restarted before it is reused.
+        """
+        if not self.is_alive():
+            raise AlpinoError("Alpino process is not running")
+        marker = "{}{}".format(ALPINO_MARKER_KEY, next(self.markers))
+        request = "".join("{key}|{sentence}\n".format(**locals()) for (key, sentence) in sentences)
+        request += "{marker}|{ALPINO_MARKER}\n".format(marker=marker, ALPINO_MARKER=ALPINO_MARKER)
+        writer = threading.Thread(target=_write, args=(self.process.stdin, request))
+        writer.daemon = True
+        writer.start()
+
+        deadline = time.time() + self.timeout
+        while True:
+            now = time.time()
+            try:
+                line = self.output.get(timeout=max(0, min(deadline, now + 2 * self.sentence_timeout) - now))
+            except Queue.Empty:
+                if time.time() >= deadline:
+                    raise AlpinoTimeout("Alpino did not finish within {self.timeout} seconds".format(**locals()))
+                raise AlpinoTimeout("Alpino did not produce output for {} seconds".format(2 * self.sentence_timeout))
+            if line is None:
+                raise AlpinoError("Alpino process exited with code {}".format(self.process.wait()))
+            key = line.rstrip("\n").rsplit("|", 1)[-1]
+            if key == marker:
+                return
+            if key.startswith(ALPINO_MARKER_KEY):
+                continue # left-over output of an earlier marker
+            yield line
+
+class AlpinoPool(object):
+    """
+    A fixed size pool of AlpinoWorkers. Workers that fail or time out are restarted.
+    """
+    def __init__(self, size=None, timeout=None, sentence_timeout=None):
+        self.size = size = ALPINO_POOL_SIZE if size is None else size
+        self.idle = Queue.Queue()
+        for i in range(size):
+            self.idle.put(AlpinoWorker(timeout=timeout, sentence_timeout=sentence_timeout))
+
+    @contextmanager
+    def worker(self):
+        """Take a worker from the pool, restarting it if it is not healthy on return"""
+        w = self.idle.get()
+        try:
+            if not w.is_alive():
+                w.restart()
+            yield w
+        except:
+            w.restart()
+            raise
+        finally:
+            self.idle.put(w)
+
+    def lines(self, sentences):
+        """Parse the (key, sentence) pairs on a free worker and yield the output lines"""
+        with self.worker() as w:
+            for line in w.lines(sentences):
+                yield line
+
+    def check(self):
+        """Check all workers, restarting unhealthy workers. Returns the number of healthy workers"""
+        workers = [self.idle.get() for i in range(self.size)]
+        healthy = 0
+        try:
+            for w in workers:
+                if w.check():
+                    healthy += 1
+                else:
+                    w.restart()
+        finally:
+            for w in workers:
+                self.idle.put(w)
+        return healthy
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().stop()
+            except Queue.Empty:
+                break
+
+_pool = None
+_long_pool = None
+_pool_lock = threading.Lock()
+
+def _start_pool(*args):
+    """Create an AlpinoPool and check that it works, raising AlpinoError if no worker responds"""
+    pool = AlpinoPool(*args)
+    if not pool.check():
+        pool.close()
+        raise AlpinoError("No Alpino worker responds, check ALPINO_HOME")
+    atexit.register(pool.close)
+    return pool
+
+def get_pool():
+    """Return the (lazily created) module-wide Alpino pool"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = _start_pool()
+        return _pool
+
+def get_long_pool():
+    """Return the (lazily created) pool for sentences longer than ALPINO_LONG_SENTENCE tokens"""
+    global _long_pool
+    with _pool_lock:
+        if _long_pool is None:
+            _long_pool = _start_pool(ALPINO_LONG_POOL_SIZE, ALPINO_LONG_TIMEOUT, ALPINO_LONG_TIMEOUT)
+        return _long_pool
 
 def interpret_parse(parse):
+    """Interpret the Alpino output (a string or an iterable of lines) as a NAF_Article"""
     article = naf.NAF_Article()
+    if isinstance(parse, basestring):
+        parse = parse.split("\n")
+    for sentence in iter_sentences(parse, article):
+        pass
+    return article
+
+def iter_sentences(lines, article=None):
+    """
+    Interpret the Alpino output lines, yielding each Sentence as soon as it is complete,
+    i.e. when the first line of the next sentence is read or the output ends
+    """
+    if article is None:
+        article = naf.NAF_Article()
     current_sentence = None
 
-    for line in parse.split("\n"):
+    for line in lines:
         if not line.strip(): continue
         line = line.strip().split("|")
         sid = int(line[-1])
         if current_sentence is None or sid != current_sentence.sentence_id:
+            if current_sentence is not None:
+                yield current_sentence
             current_sentence = article.create_sentence(sentence_id = sid)
             current_sentence.terms_by_offset = {} 
         interpret_line(current_sentence, line)
-        
-    return article
+
+    if current_sentence is not None:
+        yield current_sentence
     
 def interpret_line(sentence, line):
     if len(line) != 16:
         raise ValueError("Cannot interpret line %r, has %i parts (needed 16)" % (line, len(line)))
-    sid = int(line[-1])
     parent = interpret_token(sentence, *line[:7])
     child = interpret_token(sentence, *line[8:15])
     func, rel = line[7].split("/")
@@ -79,24 +584,36 @@ def interpret_token(sentence, lemma, word, begin, _end, dummypos, dummypos2, pos
     begin = int(begin)
     term = sentence.terms_by_offset.get(begin)
     if not term:
-        if pos == "denk_ik": pos = "verb"
-        if "(" in pos:
-            major, minor = pos.split("(", 1)
-            minor = minor[:-1]
-        else:
-            major, minor = pos, None
-        if "_" in major:
-            m2 = major.split("_")[-1]
-        else:
-            m2 = major
-        cat = POSMAP.get(m2)
+        try:
+            cat, major, minor = _POS_CACHE[pos]
+        except KeyError:
+            cat, major, minor = decode_pos(pos)
         if not cat:
-            raise Exception("Unknown POS: %r (%s/%s/%s/%s)" % (m2, major, begin, word, pos))
-            
+            raise Exception("Unknown POS: %r (%s/%s/%s/%s)" % (major.split("_")[-1], major, begin, word, pos))
         term = sentence.add_word(begin, word, lemma, pos=cat, term_extra={'major' : major, 'minor' : minor})
         sentence.terms_by_offset[begin] = term
     return term
 
+_POS_CACHE = {}
+
+def decode_pos(pos):
+    """
+    Decode an Alpino POS tag such as 'verb(hebben,past(sg),intransitive)' into a
+    (category, major, minor) triple. Results are memoized on the raw tag, as
+    there are only a few thousand distinct tags in practice
+    """
+    raw = pos
+    if pos == "denk_ik": pos = "verb"
+    if "(" in pos:
+        major, minor = pos.split("(", 1)
+        minor = minor[:-1]
+    else:
+        major, minor = pos, None
+    cat = POSMAP.get(major.split("_")[-1])
+    if cat:
+        _POS_CACHE[raw] = (cat, major, minor)
+    return cat, major, minor
+
 
 POSMAP = {"pronoun" : 'O',
           "verb" : 'V',
@@ -136,6 +653,115 @@ POSMAP = {"pronoun" : 'O',
           }
 
 
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+import unittest
+
+class TestInterpret(unittest.TestCase):
+    def setUp(self):
+        # tests use a fake ALPINO_HOME and their own pools, restore the module state afterwards
+        global _pool, _long_pool
+        self.saved = ALPINO_HOME, _pool, _long_pool
+        _pool, _long_pool = None, None
+
+    def tearDown(self):
+        global ALPINO_HOME, _pool, _long_pool
+        for pool in _pool, _long_pool:
+            if pool is not None:
+                pool.close()
+        ALPINO_HOME, _pool, _long_pool = self.saved
+
+    def test_decode_pos(self):
+        self.assertEqual(decode_pos("verb(hebben,past(sg),intransitive)"),
+                         ("V", "verb", "hebben,past(sg),intransitive"))
+        self.assertEqual(decode_pos("denk_ik"), ("V", "verb", None))
+        self.assertEqual(decode_pos("er_wh_loc_adverb"), ("B", "er_wh_loc_adverb", None))
+        self.assertIn("denk_ik", _POS_CACHE)
+        self.assertEqual(decode_pos("unknown(x)")[0], None)
+        self.assertNotIn("unknown(x)", _POS_CACHE)
+
+    def test_make_batches(self):
+        sentences = [(1, "a b"), (2, "a b c d e f"), (3, "a"), (4, "a b c"), (5, "a b c d")]
+        self.assertEqual([[key for (key, s) in batch] for batch in make_batches(sentences, batch_tokens=5)],
+                         [[2], [5], [4, 1], [3]])
+        self.assertEqual(make_batches([], batch_tokens=5), [])
+
+    def test_interpret_sentence(self):
+        a = naf.NAF_Article()
+        interpret_sentence(a, 1, ["slaap|slaapt|1|2|verb|verb(sg3)|verb(hebben,sg3,intransitive)|hd/su|"
+                                  "Jan|Jan|0|1|name|name(PER)|proper_name(sg,'PER')"])
+        # a bad line rolls back the sentence, after which the tokens can be added
+        self.assertRaises(ValueError, interpret_sentence, a, 2, [
+            "slaap|slaapt|1|2|verb|verb(sg3)|verb(hebben,sg3,intransitive)|hd/su|"
+            "Piet|Piet|0|1|name|name(PER)|proper_name(sg,'PER')", "garbage"])
+        self.assertEqual((len(a.words), len(a.terms), len(a.dependencies), len(a.sentences)), (2, 2, 1, 1))
+        add_tokens(a, 2, "Piet slaapt", AlpinoTimeout("too slow"))
+        self.assertEqual([(t.lemma, t.pos, t.error) for t in a.terms[2:]],
+                         [("Piet", "?", "AlpinoTimeout: too slow"), ("slaapt", "?", "AlpinoTimeout: too slow")])
+        self.assertEqual([(w.sentence_id, w.offset) for w in a.words[2:]], [(2, 0), (2, 1)])
+
+    def test_batch_parser(self):
+        class FakePool(object):
+            size = 1
+            def lines(self, sentences):
+                for key, sentence in sentences:
+                    if sentence == "bad":
+                        raise AlpinoTimeout(sentence)
+                    yield "{sentence}|{key}\n".format(**locals())
+        p = BatchParser({1 : 0, 2 : 0, 3 : 1, 4 : 1})
+        p.start(FakePool(), [[(1, "a"), (2, "b"), (3, "bad"), (4, "c")]])
+        p.join()
+        self.assertEqual(dict(p.output), {1 : ["a"], 2 : ["b"], 4 : ["c"]})
+        self.assertEqual(p.errors.keys(), [3])
+
+    def test_parse_batch(self):
+        global ALPINO_HOME
+        import tempfile
+        from amcatxtas.benchmarks.fake_alpino import make_alpino_home
+        ALPINO_HOME = make_alpino_home(tempfile.mkdtemp())
+        cache = SQLiteCache(":memory:")
+        for i in range(2): # sentences are numbered by line, both when parsed and when cached
+            a, = parse_batch(["Jan slaapt .\n\nPiet loopt .\n"], cache)
+            self.assertEqual([s.sentence_id for s in a.sentences], [1, 3])
+            self.assertEqual(sorted({w.sentence_id for w in a.words}), [1, 3])
+            # the separately interpreted sentences are renumbered as if interpreted in one article
+            expected = naf.NAF_Article()
+            for sid, sentence in (1, "Jan slaapt ."), (3, "Piet loopt ."):
+                interpret_sentence(expected, sid, cache.get(cache_key(sentence, AlpinoPlugin, "sentence")))
+            self.assertEqual(a.to_dict(), expected.to_dict())
+            self.assertEqual([t.term_id for t in a.sentences[1].terms], [4, 5, 6])
+        self.assertIsNotNone(_pool) # closed and reset by tearDown
+
+    def test_start_pool(self):
+        global ALPINO_HOME
+        import tempfile
+        from amcatxtas.benchmarks.fake_alpino import make_alpino_home
+        ALPINO_HOME = make_alpino_home(tempfile.mkdtemp())
+        pool = _start_pool(2)
+        self.assertEqual(pool.check(), 2)
+        pool.close()
+        ALPINO_HOME = tempfile.mkdtemp()  # an Alpino that exits immediately
+        os.mkdir(os.path.join(ALPINO_HOME, "bin"))
+        with open(os.path.join(ALPINO_HOME, "bin", "Alpino"), "w") as f:
+            f.write("#!/bin/sh\nexit 1\n")
+        os.chmod(os.path.join(ALPINO_HOME, "bin", "Alpino"), 0o755)
+        self.assertRaises(AlpinoError, _start_pool, 1)
+
+    def test_interpret_parse(self):
+        a = interpret_parse("slaap|slaapt|1|2|verb|verb(sg3)|verb(hebben,sg3,intransitive)|hd/su|"
+                            "Jan|Jan|0|1|name|name(PER)|proper_name(sg,'PER')|1\n"
+                            "slaap|slaapt|1|2|verb|verb(sg3)|verb(hebben,sg3,intransitive)|--/--|"
+                            ".|.|2|3|punct|punct(punt)|punct(punt)|1\n")
+        self.assertEqual([(t.lemma, t.pos, t.major, t.minor) for t in a.terms],
+                         [("slaap", "V", "verb", "hebben,sg3,intransitive"), ("Jan", "M", "proper_name", "sg,'PER'"),
+                          (".", ".", "punct", "punt")])
+        self.assertEqual([w.offset for w in a.words], [1, 0, 2])
+        self.assertEqual([(d.from_term, d.to_term, d.rfunc) for d in a.dependencies], [(2, 1, "su"), (3, 1, "--")])
+        self.assertEqual(a.terms[0].extra, {"major" : "verb", "minor" : "hebben,sg3,intransitive"})
+        self.assertEqual(a.words[0].extra, {})
+
 if __name__ == '__main__':
     import sys
     a = naf.NAF_Article()
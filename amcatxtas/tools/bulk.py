@@ -0,0 +1,210 @@
+####################################################################################
+#                          The MIT License (MIT)                                   #
+#                                                                                  #
+# Copyright (c) 2014 Wouter van Atteveldt                                          #
+#                                                                                  #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of  #
+# this software and associated documentation files (the "Software"), to deal in    #
+# the Software without restriction, including without limitation the rights to     #
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of #
+# the Software, and to permit persons to whom the Software is furnished to do so,  #
+# subject to the following conditions:                                             #
+#                                                                                  #
+# The above copyright notice and this permission notice shall be included in all   #
+# copies or substantial portions of the Software.                                  #
+#                                                                                  #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR       #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS #
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR   #
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER   #
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN          #
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.       #
+####################################################################################
+
+"""
+Buffered indexing of documents using the elasticsearch bulk API
+"""
+
+import json
+import time
+import threading
+import logging
+log = logging.getLogger(__name__)
+
+from elasticsearch.exceptions import TransportError, ConnectionError
+
+from amcatxtas.tools.metrics import metrics
+
+# status codes that indicate a (temporarily) overloaded cluster
+RETRY_STATUS = (429, 503)
+
+class BulkWriter(object):
+    """
+    Buffer documents and index them with the bulk API. The buffer is flushed when it
+    contains max_docs documents or max_bytes bytes of source, when max_interval seconds
+    have passed since the last flush, and on close. Items rejected by an overloaded
+    cluster are retried with exponential backoff, other failures are logged per item
+    and kept in .failed (id -> error). If on_done is given, it is called with the ids of each
+    request once they are indexed or have failed, e.g. to report them done to a work queue.
+    Documents can be added from multiple threads, a full buffer is sent by the thread that filled it.
+    """
+    def __init__(self, es, index, doc_type, max_docs=500, max_bytes=5*1024*1024, max_interval=10,
+                 max_retries=3, backoff=1, on_done=None):
+        self.es = es
+        self.index = index
+        self.doc_type = doc_type
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_interval = max_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.on_done = on_done
+        self.buffer = [] # (id, parent, source) triples
+        self.nbytes = 0
+        self.last_flush = time.time()
+        self.indexed = 0
+        self.failed = {}
+        self.lock = threading.Lock()
+
+    def add(self, id, body, parent=None):
+        """Add a document to the buffer, flushing if needed"""
+        source = json.dumps(body)
+        with self.lock:
+            self.buffer.append((id, parent, source))
+            self.nbytes += len(source)
+            full = (len(self.buffer) >= self.max_docs or self.nbytes >= self.max_bytes
+                    or time.time() - self.last_flush >= self.max_interval)
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Index all buffered documents"""
+        with self.lock:
+            items, self.buffer, self.nbytes = self.buffer, [], 0
+            self.last_flush = time.time()
+        if not items:
+            return
+        with metrics.timer("index"):
+            for attempt in range(self.max_retries + 1):
+                if not items:
+                    return
+                if attempt:
+                    time.sleep(self.backoff * 2 ** (attempt - 1))
+                    metrics.count("index_retry", len(items))
+                items = self._send(items)
+        for id, parent, source in items:
+            self._fail(id, "rejected after {self.max_retries} retries".format(**locals()))
+        self._done([id for (id, parent, source) in items])
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _fail(self, id, error):
+        log.error("Could not index {self.doc_type} {id}: {error}".format(**locals()))
+        self.failed[id] = error
+        metrics.count("index_failed")
+
+    def _done(self, ids):
+        if self.on_done is not None and ids:
+            self.on_done(ids)
+
+    def _send(self, items):
+        """Send the items in a single bulk request and return the items that should be retried"""
+        lines = []
+        for id, parent, source in items:
+            meta = {"_id": id}
+            if parent is not None:
+                meta["_parent"] = parent
+            lines += [json.dumps({"index": meta}), source]
+        try:
+            result = self.es.bulk(body="\n".join(lines) + "\n", index=self.index, doc_type=self.doc_type)
+        except ConnectionError:
+            log.warn("Could not connect for bulk request, retrying")
+            return items
+        except TransportError as e:
+            if e.status_code in RETRY_STATUS:
+                log.warn("Bulk request rejected ({e.status_code}), retrying".format(**locals()))
+                return items
+            # the whole request failed (e.g. too large), record the items so they are not lost silently
+            for id, parent, source in items:
+                self._fail(id, "bulk request failed: {e}".format(**locals()))
+            self._done([id for (id, parent, source) in items])
+            return []
+
+        retry, done = [], []
+        for item, response in zip(items, result['items']):
+            response = response['index']
+            status = response.get('status', 200)
+            if status in RETRY_STATUS:
+                retry.append(item)
+                continue
+            elif status >= 300 or 'error' in response:
+                self._fail(item[0], response.get('error'))
+            else:
+                self.indexed += 1
+                metrics.count("indexed")
+            done.append(item[0])
+        self._done(done)
+        return retry
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+import unittest
+
+class TestBulkWriter(unittest.TestCase):
+    class FakeES(object):
+        """Records bulk requests and rejects item '2' the first time it is seen"""
+        def __init__(self):
+            self.requests = []
+        def bulk(self, body, index, doc_type):
+            lines = body.strip().split("\n")
+            metas = [json.loads(l)["index"] for l in lines[::2]]
+            self.requests.append(metas)
+            items = []
+            for meta in metas:
+                status = 201
+                if meta["_id"] == 2 and len(self.requests) == 1:
+                    status = 429
+                elif meta["_id"] == 3:
+                    status = 400
+                items.append({"index" : {"_id" : meta["_id"], "status" : status}})
+            return {"items" : items}
+
+    def test_flush(self):
+        es = self.FakeES()
+        done = []
+        w = BulkWriter(es, "index", "type", max_docs=3, backoff=0, on_done=done.extend)
+        w.add(1, {"a" : 1}, parent=1)
+        w.add(2, {"a" : 2}, parent=2)
+        self.assertEqual(es.requests, [])
+        w.add(3, {"a" : 3}, parent=3)
+        self.assertEqual([m["_id"] for m in es.requests[0]], [1, 2, 3])
+        self.assertEqual(es.requests[0][0]["_parent"], 1)
+        self.assertEqual([m["_id"] for m in es.requests[1]], [2])
+        self.assertEqual(w.indexed, 2)
+        self.assertEqual(list(w.failed), [3])
+        self.assertEqual(done, [1, 3, 2]) # reported once indexed (or failed), not when added
+        w.add(4, {"a" : 4})
+        self.assertEqual(done, [1, 3, 2])
+        w.close()
+        self.assertEqual(es.requests[2], [{"_id" : 4}])
+        self.assertEqual(done, [1, 3, 2, 4])
+
+    def test_request_failed(self):
+        class FailingES(object):
+            def bulk(self, body, index, doc_type):
+                raise TransportError(413, "request too large")
+        w = BulkWriter(FailingES(), "index", "type", backoff=0)
+        w.add(1, {"a" : 1})
+        w.add(2, {"a" : 2})
+        w.close()
+        self.assertEqual(sorted(w.failed), [1, 2])
+        self.assertEqual(w.indexed, 0)
@@ -0,0 +1,146 @@
+####################################################################################
+#                          The MIT License (MIT)                                   #
+#                                                                                  #
+# Copyright (c) 2014 Wouter van Atteveldt                                          #
+#                                                                                  #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of  #
+# this software and associated documentation files (the "Software"), to deal in    #
+# the Software without restriction, including without limitation the rights to     #
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of #
+# the Software, and to permit persons to whom the Software is furnished to do so,  #
+# subject to the following conditions:                                             #
+#                                                                                  #
+# The above copyright notice and this permission notice shall be included in all   #
+# copies or substantial portions of the Software.                                  #
+#                                                                                  #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR       #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS #
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR   #
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER   #
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN          #
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.       #
+####################################################################################
+
+"""
+Content addressed caches for plugin results.
+
+Results are keyed on a hash of the (normalized) input text, the xtas_key of the plugin
+and its version (plugin.version, if present), so identical texts in different articles
+or sets are only processed once. Caches have get(key) and set(key, value) methods,
+where values are json-serializable results.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+import logging
+log = logging.getLogger(__name__)
+
+from elasticsearch.client import indices
+from elasticsearch.exceptions import NotFoundError
+
+def cache_key(text, plugin, *namespace):
+    """
+    Return the cache key for the result of the plugin on the text
+    Additional arguments are included in the key, e.g. to distinguish sentence and article results
+    """
+    if isinstance(text, unicode):
+        text = text.encode("utf-8")
+    h = hashlib.sha1(json.dumps([list(plugin.xtas_key), getattr(plugin, "version", None)] + list(namespace)))
+    h.update(text)
+    return h.hexdigest()
+
+class SQLiteCache(object):
+    """
+    Local cache in a sqlite database. Values are stored as compressed json. If there are
+    more than max_entries entries, the least recently used entries are evicted.
+    """
+    def __init__(self, path, max_entries=100000, evict_interval=1000):
+        self.max_entries = max_entries
+        self.evict_interval = evict_interval
+        self.writes = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, used REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS cache_used ON cache (used)")
+
+    def get(self, key):
+        with self.lock, self.db:
+            row = self.db.execute("SELECT value FROM cache WHERE key=?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE cache SET used=? WHERE key=?", (time.time(), key))
+        return json.loads(zlib.decompress(row[0]))
+
+    def set(self, key, value):
+        value = buffer(zlib.compress(json.dumps(value)))
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)", (key, value, time.time()))
+            self.writes += 1
+            if self.writes % self.evict_interval == 0:
+                self._evict()
+
+    def _evict(self):
+        n = self.db.execute("SELECT count(*) FROM cache").fetchone()[0] - self.max_entries
+        if n > 0:
+            log.info("Evicting {n} entries from cache".format(**locals()))
+            self.db.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY used LIMIT ?)", (n,))
+
+    def close(self):
+        self.db.close()
+
+class ESCache(object):
+    """Cache stored as unindexed json in a dedicated elasticsearch index"""
+    def __init__(self, es, index="amcatxtas_cache", doc_type="result"):
+        self.es = es
+        self.index = index
+        self.doc_type = doc_type
+        client = indices.IndicesClient(es)
+        if not client.exists(index):
+            mapping = {doc_type : {"_all" : {"enabled" : False},
+                                   "properties" : {"value" : {"type" : "string", "index" : "no"}}}}
+            client.create(index, body={"mappings" : mapping})
+
+    def get(self, key):
+        try:
+            doc = self.es.get(index=self.index, doc_type=self.doc_type, id=key)
+        except NotFoundError:
+            return None
+        return json.loads(doc['_source']['value'])
+
+    def set(self, key, value):
+        self.es.index(index=self.index, doc_type=self.doc_type, id=key, body={"value" : json.dumps(value)})
+
+    def close(self):
+        pass
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+import unittest
+
+class TestCache(unittest.TestCase):
+    def test_key(self):
+        class Plugin(object):
+            xtas_key = ("parse", "test")
+        k = cache_key(u"tekst \xe9", Plugin)
+        self.assertEqual(k, cache_key(u"tekst \xe9".encode("utf-8"), Plugin))
+        Plugin.version = 2
+        self.assertNotEqual(k, cache_key(u"tekst \xe9", Plugin))
+        self.assertNotEqual(cache_key("tekst", Plugin), cache_key("tekst", Plugin, "sentence"))
+
+    def test_sqlite(self):
+        c = SQLiteCache(":memory:", max_entries=2, evict_interval=1)
+        self.assertIsNone(c.get("a"))
+        c.set("a", {"words" : [1, 2]})
+        self.assertEqual(c.get("a"), {"words" : [1, 2]})
+        c.set("b", 2)
+        c.get("a")
+        c.set("c", 3) # b is least recently used
+        self.assertIsNone(c.get("b"))
+        self.assertEqual(c.get("a"), {"words" : [1, 2]})
+        self.assertEqual(c.get("c"), 3)
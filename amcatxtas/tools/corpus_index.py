@@ -0,0 +1,396 @@
+####################################################################################
+#                          The MIT License (MIT)                                   #
+#                                                                                  #
+# Copyright (c) 2014 Wouter van Atteveldt                                          #
+#                                                                                  #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of  #
+# this software and associated documentation files (the "Software"), to deal in    #
+# the Software without restriction, including without limitation the rights to     #
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of #
+# the Software, and to permit persons to whom the Software is furnished to do so,  #
+# subject to the following conditions:                                             #
+#                                                                                  #
+# The above copyright notice and this permission notice shall be included in all   #
+# copies or substantial portions of the Software.                                  #
+#                                                                                  #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR       #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS #
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR   #
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER   #
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN          #
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.       #
+####################################################################################
+
+"""
+Corpus index of the dependencies in the stored results of a plugin.
+
+The index holds one row per dependency with the columns in COLUMNS: the article, the sentence,
+the from and to terms, the relation and the lemma and pos of both terms. Strings are stored as
+codes into a vocabulary per kind (rfunc, lemma, pos). Rows are stored in segments of .npy column
+files in a directory, which are memory mapped when queried, so queries are vectorized numpy
+operations over the whole corpus instead of python loops over articles.
+
+Note that in the Alpino output the from term is the dependent and the to term the head, e.g.
+all subjects of 'zeggen' with their objects:
+
+    idx = CorpusIndex("/data/index")
+    su = idx.select(rfunc="su", to_lemma="zeggen")
+    obj = idx.select(rfunc="obj1", to_lemma="zeggen")
+    i, j = idx.join(su, obj)   # pairs of subject and object of the same verb
+    zip(idx.decode("from_lemma", su["from_lemma"][i]), idx.decode("from_lemma", obj["from_lemma"][j]))
+
+New results can be added with add(aid, article), e.g. by NLPRunner as it stores results
+(see --corpus-index), and are written as a new segment on flush. Results that were
+stored before can be added with build (see the build command below).
+"""
+
+import os
+import json
+import time
+import fcntl
+import shutil
+import threading
+import logging
+log = logging.getLogger(__name__)
+
+import numpy as np
+
+from amcatxtas.tools import naf, naf_binary
+from amcatxtas.tools.export import decode, get_results, Exporter
+
+COLUMNS = [("article", np.int64), ("sentence", np.int32), ("from_term", np.int32), ("to_term", np.int32),
+           ("rfunc", np.int32), ("from_lemma", np.int32), ("from_pos", np.int32),
+           ("to_lemma", np.int32), ("to_pos", np.int32)]
+# vocabulary of the string columns
+VOCABULARY = {"rfunc" : "rfunc", "from_lemma" : "lemma", "to_lemma" : "lemma", "from_pos" : "pos", "to_pos" : "pos"}
+LAYERS = ["words", "terms", "dependencies"]
+
+class Vocabulary(object):
+    """Append-only mapping of strings to integer codes"""
+    def __init__(self, values=()):
+        self.values = list(values)
+        self.codes = {v : i for (i, v) in enumerate(self.values)}
+
+    def code(self, value):
+        """Return the code of the value, adding it if needed"""
+        try:
+            return self.codes[value]
+        except KeyError:
+            self.codes[value] = len(self.values)
+            self.values.append(value)
+            return self.codes[value]
+
+    def get(self, value):
+        """Return the code of the value, or -1 if it is unknown"""
+        return self.codes.get(value, -1)
+
+    def __len__(self):
+        return len(self.values)
+
+class CorpusIndex(object):
+    """
+    Dependency index stored in a directory. Rows added with add are kept in memory until flush
+    (or segment_size rows), which writes them as a new segment. Adding and flushing is thread safe,
+    and runners in multiple processes can append to the same index, as changes to the list of
+    segments and the vocabulary are made under a file lock.
+    """
+    def __init__(self, path, segment_size=1000000):
+        self.path = path
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.rows = []
+        self.pending = set() # articles in self.rows
+        self.vocabulary = {}
+        self.manifest = None
+        self._segments = {} # name : {column : memmapped array}
+        self._articles = None
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.reload()
+
+    def _file(self, *names):
+        return os.path.join(self.path, *names)
+
+    def reload(self):
+        """Read the list of segments and the vocabulary, e.g. to see segments added by other processes"""
+        try:
+            with open(self._file("manifest.json")) as f:
+                manifest = json.load(f)
+        except IOError:
+            manifest = {"segments" : [], "vocabulary" : {}}
+        with self.lock:
+            self.manifest = manifest
+            for kind in set(VOCABULARY.values()):
+                # keep codes for strings that were added since the last flush
+                vocabulary = Vocabulary(manifest["vocabulary"].get(kind, []))
+                for value in self.vocabulary.get(kind, Vocabulary()).values:
+                    vocabulary.code(value)
+                self.vocabulary[kind] = vocabulary
+            self._articles = None
+
+    def segments(self):
+        """Return the segments as a list of {column : array} dicts"""
+        result = []
+        for name in self.manifest["segments"]:
+            if name not in self._segments:
+                self._segments[name] = {c : np.load(self._file(name, c + ".npy"), mmap_mode="r") for (c, t) in COLUMNS}
+            result.append(self._segments[name])
+        return result
+
+    def articles(self):
+        """Return the set of indexed article ids"""
+        if self._articles is None:
+            self._articles = set()
+            for name in self.manifest["segments"]:
+                self._articles.update(np.load(self._file(name, "articles.npy")).tolist())
+        return self._articles
+
+    def __len__(self):
+        return sum(len(s["article"]) for s in self.segments())
+
+    # adding results
+
+    def add(self, aid, article):
+        """Add the dependencies of an article, unless it is already in the index"""
+        with self.lock:
+            if aid in self.pending or aid in self.articles():
+                return
+            code = lambda kind, value: self.vocabulary[kind].code(value)
+            terms = {t.term_id : t for t in article.terms}
+            sentences = {w.word_id : w.sentence_id for w in article.words}
+            for d in article.dependencies:
+                f, t = terms.get(d.from_term), terms.get(d.to_term)
+                if f is None or t is None:
+                    continue
+                self.rows.append((aid, sentences.get(f.word_ids[0], 0), d.from_term, d.to_term, code("rfunc", d.rfunc),
+                                  code("lemma", f.lemma), code("pos", f.pos), code("lemma", t.lemma), code("pos", t.pos)))
+            self.pending.add(aid)
+            full = len(self.rows) >= self.segment_size
+        if full:
+            self.flush()
+
+    def add_body(self, aid, body):
+        """Add a stored result (in json or binary format), skipping failures"""
+        if "error" not in body:
+            self.add(aid, decode(body, LAYERS))
+
+    def flush(self):
+        """Write the added rows as a new segment"""
+        with self.lock:
+            rows, articles, self.rows, self.pending = self.rows, self.pending, [], set()
+            if not articles:
+                return
+            name = "segment-{:d}-{:d}".format(int(time.time() * 1000), os.getpid())
+            tmp = self._file(name + ".tmp")
+            os.makedirs(tmp)
+            columns = zip(*rows) if rows else [()] * len(COLUMNS)
+            for (column, dtype), values in zip(COLUMNS, columns):
+                np.save(os.path.join(tmp, column + ".npy"), np.array(values, dtype=dtype))
+            np.save(os.path.join(tmp, "articles.npy"), np.array(sorted(articles), dtype=np.int64))
+            os.rename(tmp, self._file(name))
+            with open(self._file(".lock"), "w") as lockfile:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+                self._update_manifest(name)
+            self._articles = None
+            log.debug("Added segment {name} with {n} dependencies".format(n=len(rows), **locals()))
+
+    def _update_manifest(self, name):
+        """Add the segment to the manifest, merging the vocabulary with strings added by other processes"""
+        try:
+            with open(self._file("manifest.json")) as f:
+                manifest = json.load(f)
+        except IOError:
+            manifest = {"segments" : [], "vocabulary" : {}}
+        for kind, vocabulary in self.vocabulary.items():
+            stored = manifest["vocabulary"].get(kind, [])
+            if vocabulary.values[:len(stored)] != stored:
+                # another process added other strings, renumber this segment to the stored vocabulary
+                self._recode(name, kind, stored)
+                stored = self.vocabulary[kind].values
+            manifest["vocabulary"][kind] = vocabulary.values if len(vocabulary) > len(stored) else stored
+        manifest["segments"].append(name)
+        tmp = self._file("manifest.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+        os.rename(tmp, self._file("manifest.json"))
+        self.manifest = manifest
+
+    def _recode(self, name, kind, stored):
+        """Recode the columns of the segment using the given stored vocabulary (extended with new strings)"""
+        vocabulary = Vocabulary(stored)
+        mapping = np.array([vocabulary.code(v) for v in self.vocabulary[kind].values], dtype=np.int32)
+        for column, k in VOCABULARY.items():
+            if k == kind:
+                fn = self._file(name, column + ".npy")
+                np.save(fn, mapping[np.load(fn)])
+        self.vocabulary[kind] = vocabulary
+
+    def close(self):
+        self.flush()
+
+    # queries
+
+    def codes(self, column, values):
+        """Return the codes of the value(s) for a string column as an array (unknown values are left out)"""
+        if isinstance(values, basestring):
+            values = [values]
+        vocabulary = self.vocabulary[VOCABULARY[column]]
+        return np.array([c for c in (vocabulary.get(v) for v in values) if c >= 0], dtype=np.int32)
+
+    def decode(self, column, codes):
+        """Return the strings for an array of codes of a string column"""
+        values = np.array(self.vocabulary[VOCABULARY[column]].values + [None], dtype=object)
+        return values[codes].tolist()
+
+    def mask(self, segment, **filters):
+        """Return a boolean array of the rows of the segment that match the filters, see select"""
+        mask = np.ones(len(segment["article"]), dtype=bool)
+        for column, values in filters.items():
+            if column in VOCABULARY:
+                values = self.codes(column, values)
+            elif np.isscalar(values):
+                values = [values]
+            mask &= np.in1d(segment[column], values)
+        return mask
+
+    def select(self, **filters):
+        """
+        Return the rows that match all filters as a dict of column : array.
+        Filters are column=value(s) pairs, with values as strings for rfunc, lemma and pos columns,
+        e.g. select(rfunc="su", to_pos="V").
+        """
+        parts = {column : [] for (column, dtype) in COLUMNS}
+        for segment in self.segments():
+            mask = self.mask(segment, **filters)
+            for column in parts:
+                parts[column].append(segment[column][mask])
+        return {column : np.concatenate(parts[column]) if parts[column] else np.empty(0, dtype=dtype)
+                for (column, dtype) in COLUMNS}
+
+    def count(self, column, **filters):
+        """Return a list of (value, count) pairs for the column in the rows matching the filters, most frequent first"""
+        values, counts = np.unique(self.select(**filters)[column], return_counts=True)
+        order = np.argsort(-counts, kind="mergesort")
+        if column in VOCABULARY:
+            values = self.decode(column, values[order])
+        else:
+            values = values[order].tolist()
+        return zip(values, counts[order].tolist())
+
+    def join(self, left, right, on="to"):
+        """
+        Join two selections on their shared term, i.e. rows of the same article with the same to_term
+        (on="to") or from_term (on="from"). Returns a pair of index arrays (i, j) so that left[c][i] and
+        right[c][j] are the joined rows.
+        """
+        term = on + "_term"
+        a = left["article"].astype(np.int64) << 32 | left[term]
+        b = right["article"].astype(np.int64) << 32 | right[term]
+        order = np.argsort(b, kind="mergesort")
+        b = b[order]
+        lo, hi = np.searchsorted(b, a, "left"), np.searchsorted(b, a, "right")
+        counts = hi - lo
+        i = np.repeat(np.arange(len(a)), counts)
+        starts = np.cumsum(counts) - counts
+        j = order[np.repeat(lo - starts, counts) + np.arange(counts.sum())]
+        return i, j
+
+def build(index, es, doctype, setid, chunk_width=10000):
+    """Add the stored results of the articles in the set that are not yet indexed"""
+    chunks = Exporter(es, doctype, setid, None, chunk_width=chunk_width).get_chunks()
+    for i, chunk in enumerate(sorted(chunks)):
+        ids = sorted(set(chunks[chunk]) - index.articles())
+        for aid, article in get_results(es, doctype, ids, LAYERS):
+            index.add(aid, article)
+        index.flush()
+        log.info("Indexed chunk {i} / {n}, {ndeps} dependencies".format(n=len(chunks), ndeps=len(index), **locals()))
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+import unittest
+import tempfile
+
+class TestCorpusIndex(unittest.TestCase):
+    def article(self, *sentences):
+        """Create an article with the given sentences of (subject, verb, object) lemmas"""
+        a = naf.NAF_Article()
+        for su, verb, obj in sentences:
+            s = a.create_sentence()
+            t1, t2, t3 = [s.add_word(i, w, w, p) for (i, (w, p)) in enumerate([(su, "N"), (verb, "V"), (obj, "N")])]
+            s.add_dependency(t1.term_id, t2.term_id, "su")
+            s.add_dependency(t3.term_id, t2.term_id, "obj1")
+        return a
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_index(self):
+        idx = CorpusIndex(self.path)
+        idx.add(1, self.article(("jan", "zien", "piet"), ("piet", "zeggen", "iets")))
+        idx.flush()
+        idx.add(2, self.article(("marie", "zien", "jan")))
+        idx.add(1, self.article(("jan", "zien", "piet"))) # already indexed
+        idx.add_body(3, {"error" : "failed"})
+        idx.add_body(4, naf_binary.serialize(self.article(("kees", "zeggen", "niets"))))
+        idx.flush()
+
+        idx = CorpusIndex(self.path)
+        self.assertEqual(len(idx.manifest["segments"]), 2)
+        self.assertEqual(idx.articles(), {1, 2, 4})
+        self.assertEqual(len(idx), 8)
+        su = idx.select(rfunc="su", to_lemma="zien")
+        self.assertEqual(idx.decode("from_lemma", su["from_lemma"]), ["jan", "marie"])
+        self.assertEqual(su["sentence"].tolist(), [1, 1])
+        self.assertEqual(sorted(idx.count("to_lemma", rfunc="obj1")), [("zeggen", 2), ("zien", 2)])
+        self.assertEqual(len(idx.select(rfunc="unknown")["article"]), 0)
+        obj = idx.select(rfunc="obj1")
+        i, j = idx.join(su, obj)
+        self.assertEqual(zip(su["article"][i].tolist(), idx.decode("from_lemma", su["from_lemma"][i]),
+                             idx.decode("from_lemma", obj["from_lemma"][j])),
+                         [(1, "jan", "piet"), (2, "marie", "jan")])
+
+    def test_concurrent_vocabulary(self):
+        a, b = CorpusIndex(self.path), CorpusIndex(self.path)
+        a.add(1, self.article(("jan", "zien", "piet")))
+        b.add(2, self.article(("marie", "zeggen", "iets")))
+        a.flush()
+        b.flush()
+        idx = CorpusIndex(self.path)
+        self.assertEqual(sorted(idx.count("from_lemma", rfunc="su")), [("jan", 1), ("marie", 1)])
+        self.assertEqual(sorted(idx.count("to_lemma")), [("zeggen", 2), ("zien", 2)])
+
+if __name__ == '__main__':
+    logging.basicConfig(format='[%(asctime)s %(levelname)s %(name)s:%(lineno)s] %(message)s', level=logging.INFO)
+
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command")
+    p = subparsers.add_parser("build", help="Add the stored results of a set to the index")
+    p.add_argument('path', help="Directory of the index")
+    p.add_argument('plugin', help="Plugin whose results are indexed, e.g. amcatxtas.plugins.alpino.AlpinoPlugin")
+    p.add_argument('articleset', type=int)
+    p = subparsers.add_parser("count", help="Count the values of a column in the matching dependencies")
+    p.add_argument('path', help="Directory of the index")
+    p.add_argument('column', help="Column to count, e.g. from_lemma")
+    p.add_argument('filters', nargs="*", help="Filters as column=value, e.g. rfunc=su to_lemma=zeggen")
+    p.add_argument('--number', '-n', type=int, default=25, help="Number of values to show")
+    args = parser.parse_args()
+
+    idx = CorpusIndex(args.path)
+    if args.command == "build":
+        from amcatxtas.tools.process_batch import import_attribute
+        from amcatxtas.tools.esclient import connect
+        plugin = import_attribute(args.plugin)
+        build(idx, connect(), "_".join(plugin.xtas_key), args.articleset)
+    else:
+        filters = dict(f.split("=", 1) for f in args.filters)
+        for column, value in filters.items():
+            if column not in VOCABULARY:
+                filters[column] = int(value)
+        for value, n in idx.count(args.column, **filters)[:args.number]:
+            print u"{n:10d} {value}".format(**locals()).encode("utf-8")
@@ -0,0 +1,198 @@
+####################################################################################
+#                          The MIT License (MIT)                                   #
+#                                                                                  #
+# Copyright (c) 2014 Wouter van Atteveldt                                          #
+#                                                                                  #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of  #
+# this software and associated documentation files (the "Software"), to deal in    #
+# the Software without restriction, including without limitation the rights to     #
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of #
+# the Software, and to permit persons to whom the Software is furnished to do so,  #
+# subject to the following conditions:                                             #
+#                                                                                  #
+# The above copyright notice and this permission notice shall be included in all   #
+# copies or substantial portions of the Software.                                  #
+#                                                                                  #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR       #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS #
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR   #
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER   #
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN          #
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.       #
+####################################################################################
+
+"""
+Configuration of the elasticsearch client used by the runners.
+
+The client connects to one or more hosts (ES_HOSTS, or ES_HOST and ES_PORT), keeps a pool of
+connections per host that should be at least as large as the number of threads using it, and
+retries requests that fail on a connection error or are rejected by an overloaded cluster with
+exponential backoff, instead of failing the run.
+"""
+
+import os
+import time
+import logging
+log = logging.getLogger(__name__)
+
+from elasticsearch import Elasticsearch, Transport
+from elasticsearch.exceptions import TransportError, ConnectionError, ConnectionTimeout
+
+from amcatxtas.tools.bulk import RETRY_STATUS
+from amcatxtas.tools.metrics import metrics
+
+ES_HOST = os.environ.get("ES_HOST", 'localhost')
+ES_PORT = os.environ.get("ES_PORT", 9200)
+ES_HOSTS = os.environ.get("ES_HOSTS") # comma separated host[:port] list, overrides ES_HOST and ES_PORT
+ES_TIMEOUT = float(os.environ.get("ES_TIMEOUT", 30))
+ES_MAX_RETRIES = int(os.environ.get("ES_MAX_RETRIES", 5))
+ES_BACKOFF = float(os.environ.get("ES_BACKOFF", 1))
+ES_POOL_SIZE = int(os.environ.get("ES_POOL_SIZE", 10)) # connections per host
+ES_SNIFF = os.environ.get("ES_SNIFF", "").lower() in ("1", "true", "yes")
+
+def get_hosts(hosts=None):
+    """Return a list of host dicts for a comma separated host[:port] string, by default ES_HOSTS or ES_HOST:ES_PORT"""
+    if hosts is None:
+        if ES_HOSTS is None:
+            return [{"host" : ES_HOST, "port" : int(ES_PORT)}]
+        hosts = ES_HOSTS
+    result = []
+    for host in hosts.split(","):
+        host, _, port = host.strip().partition(":")
+        result.append({"host" : host, "port" : int(port or ES_PORT)})
+    return result
+
+class RetryTransport(Transport):
+    """
+    Transport that retries requests that failed because of a connection error or were rejected
+    with one of the RETRY_STATUS codes, waiting backoff * 2**attempt seconds between attempts.
+    Bulk requests are not retried, as BulkWriter retries them (and their rejected items) itself.
+    Creates are not retried on a connection error, as the document may have been created,
+    and retrying would then fail with a conflict on our own document.
+    """
+    def __init__(self, hosts, max_retries=ES_MAX_RETRIES, backoff=ES_BACKOFF, **kargs):
+        # the transport itself only moves on to the next node, without waiting
+        super(RetryTransport, self).__init__(hosts, max_retries=0, **kargs)
+        self.retries = max_retries
+        self.backoff = backoff
+
+    def perform_request(self, method, url, params=None, body=None):
+        if url.endswith("/_bulk"):
+            return super(RetryTransport, self).perform_request(method, url, params, body)
+        create = (params or {}).get("op_type") == "create"
+        for attempt in range(self.retries + 1):
+            try:
+                # the transport pops options such as ignore from params, so pass a copy
+                return super(RetryTransport, self).perform_request(method, url, params and dict(params), body)
+            except TransportError as e:
+                if isinstance(e, ConnectionTimeout):
+                    retry = self.retry_on_timeout and not create
+                elif isinstance(e, ConnectionError):
+                    retry = not create
+                else:
+                    retry = e.status_code in RETRY_STATUS
+                if not retry or attempt == self.retries:
+                    raise
+                wait = self.backoff * 2 ** attempt
+                log.warn("{method} {url} failed ({e.status_code}), retrying in {wait}s".format(**locals()))
+                metrics.count("es_retry")
+                time.sleep(wait)
+
+def connect(hosts=None, pool_size=None, timeout=None, max_retries=None, backoff=None, sniff=None):
+    """
+    Return an Elasticsearch client, using the ES_* settings for arguments that are None.
+    pool_size is the number of connections per host, and should be at least the number of threads using
+    the client. If sniff is True, the nodes of the cluster are discovered on start and when a node fails.
+    """
+    sniff = ES_SNIFF if sniff is None else sniff
+    return Elasticsearch(get_hosts(hosts), transport_class=RetryTransport,
+                         maxsize=ES_POOL_SIZE if pool_size is None else pool_size,
+                         timeout=ES_TIMEOUT if timeout is None else timeout,
+                         max_retries=ES_MAX_RETRIES if max_retries is None else max_retries,
+                         backoff=ES_BACKOFF if backoff is None else backoff,
+                         sniff_on_start=sniff, sniff_on_connection_fail=sniff,
+                         sniffer_timeout=60 if sniff else None)
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+import unittest
+import json
+import threading
+import BaseHTTPServer
+
+class TestConnect(unittest.TestCase):
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        """
+        Rejects the first `reject` requests with 429, and echoes the path of the others,
+        or closes the connection without a response if `drop` is set
+        """
+        def do_GET(self):
+            if self.headers.get("Content-Length"):
+                self.rfile.read(int(self.headers["Content-Length"]))
+            self.server.requests.append(self.path)
+            if self.server.drop:
+                self.close_connection = 1
+                return
+            if len(self.server.requests) <= self.server.reject:
+                status, body = 429, {"error" : "rejected"}
+            else:
+                status, body = 200, {"path" : self.path}
+            body = json.dumps(body)
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        do_POST = do_PUT = do_GET
+        def log_message(self, *args):
+            pass
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(("localhost", 0), self.Handler)
+        self.server.requests = []
+        self.server.drop = False
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.hosts = "localhost:{}".format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_hosts(self):
+        self.assertEqual(get_hosts("a:1, b"), [{"host" : "a", "port" : 1}, {"host" : "b", "port" : int(ES_PORT)}])
+
+    def test_retry(self):
+        self.server.reject = 2
+        es = connect(self.hosts, max_retries=2, backoff=0.01)
+        self.assertEqual(es.transport.perform_request("GET", "/test")[1], {"path" : "/test"})
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_give_up(self):
+        self.server.reject = 10
+        es = connect(self.hosts, max_retries=1, backoff=0.01)
+        try:
+            es.transport.perform_request("GET", "/test")
+            self.fail("Expected TransportError")
+        except TransportError as e:
+            self.assertEqual(e.status_code, 429)
+        self.assertEqual(len(self.server.requests), 2)
+        # ignored statuses are not retried
+        self.server.requests = []
+        self.assertEqual(es.transport.perform_request("GET", "/test", params={"ignore" : 429})[0], 429)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_single_retry_layer(self):
+        self.server.reject = 10
+        es = connect(self.hosts, max_retries=2, backoff=0.01)
+        self.assertRaises(TransportError, es.bulk, body=[{"index" : {"_id" : 1}}, {"a" : 1}], index="i", doc_type="t")
+        self.assertEqual(len(self.server.requests), 1) # left to BulkWriter
+        self.server.requests, self.server.drop = [], True
+        self.assertRaises(ConnectionError, es.get, index="i", doc_type="t", id=1)
+        self.assertEqual(len(self.server.requests), 3)
+        self.server.requests = []
+        self.assertRaises(ConnectionError, es.create, index="i", doc_type="t", id=1, body={})
+        self.assertEqual(len(self.server.requests), 1) # it may have been created
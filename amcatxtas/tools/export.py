@@ -0,0 +1,292 @@
+####################################################################################
+#                          The MIT License (MIT)                                   #
+#                                                                                  #
+# Copyright (c) 2014 Wouter van Atteveldt                                          #
+#                                                                                  #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of  #
+# this software and associated documentation files (the "Software"), to deal in    #
+# the Software without restriction, including without limitation the rights to     #
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of #
+# the Software, and to permit persons to whom the Software is furnished to do so,  #
+# subject to the following conditions:                                             #
+#                                                                                  #
+# The above copyright notice and this permission notice shall be included in all   #
+# copies or substantial portions of the Software.                                  #
+#                                                                                  #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR       #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS #
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR   #
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER   #
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN          #
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.       #
+####################################################################################
+
+"""
+Export the cached results of a plugin for all articles in a set.
+
+The ids of the articles with a result are enumerated with a scan and grouped into
+chunks by id range. Chunks are fetched (with mget on the child documents) and written
+in parallel threads, each chunk to its own part file in the output directory. Part files
+are written under a temporary name and renamed when complete, so an interrupted export
+can be resumed by running it again: existing parts are skipped.
+"""
+
+import bz2
+import gzip
+import json
+import os
+import struct
+import threading
+import time
+import Queue
+import logging
+log = logging.getLogger(__name__)
+
+from elasticsearch import helpers
+
+from amcatxtas.tools import naf, naf_binary
+from amcatxtas.tools.process_batch import import_attribute, ES_INDEX, ES_ARTICLE_DOCTYPE
+from amcatxtas.tools.esclient import connect, ES_POOL_SIZE
+
+def decode(body, layers=None):
+    """Decode a stored result (in json or binary format) as a NAF_Article, decoding only the given layers if given"""
+    if "naf_binary" in body:
+        return naf_binary.deserialize(body, layers)
+    return naf.NAF_Article.from_dict(body)
+
+def get_results(es, doctype, ids, layers=None, batch_size=500):
+    """
+    Yield aid, article pairs for the stored results of the given article ids that exist and did not fail.
+    If layers is given, only those layers are fetched (using source filtering) and decoded.
+    """
+    source = True if layers is None else list(layers) + ["naf_binary", "error"]
+    for i in range(0, len(ids), batch_size):
+        docs = [{"_id" : id, "_routing" : id, "_source" : source} for id in ids[i:i+batch_size]]
+        result = es.mget(index=ES_INDEX, doc_type=doctype, body={"docs" : docs})
+        for doc in result['docs']:
+            if doc.get('found') and "error" not in doc['_source']: # skip failed articles
+                yield int(doc['_id']), decode(doc['_source'], layers)
+
+def write_jsonl(f, articles):
+    for aid, article in articles:
+        d = article.to_dict()
+        d["id"] = aid
+        f.write(json.dumps(d) + "\n")
+
+def write_naf(f, articles):
+    naf.write_corpus(articles, f)
+
+def write_binary(f, articles):
+    """Write the articles as records of aid (int64), length (uint32) and the binary article"""
+    for aid, article in articles:
+        data = naf_binary.encode(article)
+        f.write(struct.pack("<qI", int(aid), len(data)) + data)
+
+# format : (extension, writer function)
+FORMATS = {"jsonl" : ("jsonl", write_jsonl),
+           "naf" : ("xml", write_naf),
+           "binary" : ("nafb", write_binary)}
+
+# compression : (extension, open function)
+COMPRESSION = {None : ("", open),
+               "gzip" : (".gz", gzip.open),
+               "bz2" : (".bz2", bz2.BZ2File)}
+
+class Exporter(object):
+    def __init__(self, es, doctype, setid, output, format="jsonl", compression=None, threads=4,
+                 chunk_width=10000, report_interval=30, layers=None):
+        self.es = es
+        self.layers = layers
+        self.doctype = doctype
+        self.setid = setid
+        self.output = output
+        self.format = format
+        self.compression = compression
+        self.threads = threads
+        self.chunk_width = chunk_width
+        self.report_interval = report_interval
+        self.lock = threading.Lock()
+        self.docs, self.bytes, self.failed = 0, 0, 0
+
+    def get_chunks(self):
+        """Return a dict of chunk : ids for the articles in the set that have a result"""
+        filter = {"bool" : {"must" : [{"term" : {"sets" : self.setid}},
+                                      {"has_child" : {"type" : self.doctype, "query" : {"match_all" : {}}}}]}}
+        body = {"query" : {"filtered" : {"filter" : filter}}}
+        chunks = {}
+        for hit in helpers.scan(self.es, query=body, index=ES_INDEX, doc_type=ES_ARTICLE_DOCTYPE, fields=[]):
+            id = int(hit['_id'])
+            chunks.setdefault(id // self.chunk_width, []).append(id)
+        return chunks
+
+    def get_filename(self, chunk):
+        ext = FORMATS[self.format][0] + COMPRESSION[self.compression][0]
+        return os.path.join(self.output, "part-{chunk:08d}.{ext}".format(**locals()))
+
+    def get_articles(self, ids):
+        """Yield aid, article pairs for the given ids"""
+        return get_results(self.es, self.doctype, ids, self.layers)
+
+    def export_chunk(self, chunk, ids):
+        fn = self.get_filename(chunk)
+        tmp = fn + ".tmp"
+        writer = FORMATS[self.format][1]
+        open_file = COMPRESSION[self.compression][1]
+        counter = _Counter(self.get_articles(sorted(ids)))
+        f = open_file(tmp, "wb")
+        try:
+            writer(f, counter)
+        finally:
+            f.close()
+        os.rename(tmp, fn)
+        with self.lock:
+            self.docs += counter.n
+            self.bytes += os.path.getsize(fn)
+
+    def _work(self, chunks):
+        while True:
+            try:
+                chunk, ids = chunks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                self.export_chunk(chunk, ids)
+            except Exception:
+                log.exception("Error on exporting chunk {chunk}, will be retried on the next run".format(**locals()))
+                with self.lock:
+                    self.failed += 1
+
+    def run(self):
+        if not os.path.exists(self.output):
+            os.makedirs(self.output)
+        chunks = self.get_chunks()
+        todo = Queue.Queue()
+        for chunk in sorted(chunks):
+            if not os.path.exists(self.get_filename(chunk)):
+                todo.put((chunk, chunks[chunk]))
+        log.info("Exporting {n} of {m} chunks".format(n=todo.qsize(), m=len(chunks)))
+
+        self.start = time.time()
+        threads = [threading.Thread(target=self._work, args=(todo,)) for i in range(self.threads)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        while any(t.is_alive() for t in threads):
+            for t in threads:
+                t.join(self.report_interval)
+                if t.is_alive():
+                    break
+            self.report()
+        if self.failed:
+            log.warn("{self.failed} chunks failed, run again to retry".format(**locals()))
+
+    def report(self):
+        elapsed = time.time() - self.start
+        mb = self.bytes / 1024. / 1024
+        log.info("Exported {self.docs} articles ({docs_rate:.1f}/s), {mb:.1f}MB ({mb_rate:.2f}MB/s)".format(
+            docs_rate=self.docs / elapsed, mb_rate=mb / elapsed, **locals()))
+
+class _Counter(object):
+    """Iterable wrapper that counts the number of items"""
+    def __init__(self, items):
+        self.items = items
+        self.n = 0
+
+    def __iter__(self):
+        for item in self.items:
+            self.n += 1
+            yield item
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+import unittest
+
+class TestExport(unittest.TestCase):
+    class FakeES(object):
+        """Serves mget requests from a dict id : source, applying source filtering"""
+        def __init__(self, sources):
+            self.sources = sources
+            self.requests = []
+        def mget(self, index, doc_type, body):
+            self.requests.append(body["docs"])
+            docs = []
+            for doc in body["docs"]:
+                if doc["_id"] == 99:
+                    raise Exception("mget failed")
+                source = self.sources.get(doc["_id"])
+                if source is None:
+                    docs.append({"_id" : str(doc["_id"]), "found" : False})
+                    continue
+                if doc["_source"] is not True:
+                    source = {k : v for (k, v) in source.items() if k in doc["_source"]}
+                docs.append({"_id" : str(doc["_id"]), "found" : True, "_source" : source})
+            return {"docs" : docs}
+
+    class FixedExporter(Exporter):
+        def __init__(self, chunks, *args, **kargs):
+            super(TestExport.FixedExporter, self).__init__(*args, **kargs)
+            self.chunks = chunks
+        def get_chunks(self):
+            return self.chunks
+
+    def get_es(self):
+        article = naf.NAF_Article()
+        s = article.create_sentence()
+        s.add_dependency(s.add_word(0, "Jan", "Jan", "M").term_id, s.add_word(1, "slaapt", "slaap", "V").term_id, "su")
+        as_json = {layer : [x._asdict() for x in getattr(article, layer)] for layer in ("words", "terms", "dependencies")}
+        return self.FakeES({1 : as_json, 2 : naf_binary.serialize(article), 3 : {"error" : "ValueError: x"},
+                            12 : as_json})
+
+    def test_get_results(self):
+        es = self.get_es()
+        results = list(get_results(es, "test", [1, 2, 3, 4], batch_size=3))
+        self.assertEqual([aid for (aid, a) in results], [1, 2]) # 3 failed, 4 does not exist
+        self.assertEqual(len(es.requests), 2)
+        for aid, a in results: # both formats decode
+            self.assertEqual([w.word for w in a.words], ["Jan", "slaapt"])
+            self.assertEqual([(d.from_term, d.to_term) for d in a.dependencies], [(1, 2)])
+        results = list(get_results(es, "test", [1, 2, 3], layers=["words"]))
+        self.assertEqual(es.requests[-1][0]["_source"], ["words", "naf_binary", "error"])
+        self.assertEqual([aid for (aid, a) in results], [1, 2])
+        for aid, a in results:
+            self.assertEqual([w.word for w in a.words], ["Jan", "slaapt"])
+        self.assertEqual(results[0][1].terms, []) # filtered out
+
+    def test_run(self):
+        import tempfile
+        output = tempfile.mkdtemp()
+        e = self.FixedExporter({0 : [1, 2, 3], 1 : [12], 9 : [99]}, self.get_es(), "test", 1, output, chunk_width=10)
+        with open(e.get_filename(1), "w") as f:
+            f.write("existing")
+        e.run()
+        with open(e.get_filename(0)) as f:
+            self.assertEqual([json.loads(line)["id"] for line in f], [1, 2])
+        with open(e.get_filename(1)) as f:
+            self.assertEqual(f.read(), "existing") # skipped, so an export can be resumed
+        self.assertFalse(os.path.exists(e.get_filename(9))) # failed, so it is retried on the next run
+        self.assertEqual(sorted(os.listdir(output)), ["part-00000000.jsonl", "part-00000001.jsonl", "part-00000009.jsonl.tmp"])
+        self.assertEqual((e.docs, e.failed), (2, 1))
+
+if __name__ == '__main__':
+    logging.basicConfig(format='[%(asctime)s %(levelname)s %(name)s:%(lineno)s] %(message)s', level=logging.INFO)
+
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--format', '-f', choices=sorted(FORMATS), default="jsonl")
+    parser.add_argument('--compression', '-c', choices=[c for c in COMPRESSION if c])
+    parser.add_argument('--threads', '-t', default=4, type=int)
+    parser.add_argument('--chunk-width', default=10000, type=int, help="Size of the article id range per part file")
+    parser.add_argument('--layers', type=lambda s: s.split(","),
+                        help="Only export these (comma separated) layers, e.g. words,terms")
+    parser.add_argument('plugin')
+    parser.add_argument('articleset', type=int)
+    parser.add_argument('output', help="Output directory")
+    args = parser.parse_args()
+
+    plugin = import_attribute(args.plugin)
+    es = connect(pool_size=max(ES_POOL_SIZE, args.threads + 1))
+    doctype = "_".join(plugin.xtas_key)
+    Exporter(es, doctype, args.articleset, args.output, format=args.format, compression=args.compression,
+             threads=args.threads, chunk_width=args.chunk_width, layers=args.layers).run()
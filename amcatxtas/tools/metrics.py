@@ -0,0 +1,260 @@
+####################################################################################
+#                          The MIT License (MIT)                                   #
+#                                                                                  #
+# Copyright (c) 2014 Wouter van Atteveldt                                          #
+#                                                                                  #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of  #
+# this software and associated documentation files (the "Software"), to deal in    #
+# the Software without restriction, including without limitation the rights to     #
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of #
+# the Software, and to permit persons to whom the Software is furnished to do so,  #
+# subject to the following conditions:                                             #
+#                                                                                  #
+# The above copyright notice and this permission notice shall be included in all   #
+# copies or substantial portions of the Software.                                  #
+#                                                                                  #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR       #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS #
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR   #
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER   #
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN          #
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.       #
+####################################################################################
+
+"""
+Timings, counters and failure counts for the stages of the NLP pipeline.
+
+Stages are timed with metrics.timer(stage), which records the latency, optionally
+the latency per token, and failures by exception type. The module level metrics
+object is used by the runner and plugins; its state can be summarized in the log,
+written as Prometheus text to a file, or served over http.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import logging
+log = logging.getLogger(__name__)
+
+INF = float("inf")
+# upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = (.001, .005, .01, .05, .1, .5, 1, 5, 10, 30, 60, 300, INF)
+TOKEN_BUCKETS = (.00001, .0001, .0005, .001, .005, .01, .05, .1, 1, INF)
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def merge(self, counts, sum, count):
+        self.counts = [a + b for (a, b) in zip(self.counts, counts)]
+        self.sum += sum
+        self.count += count
+
+    def quantile(self, q):
+        """Estimate the quantile as the upper bound of the bucket that contains it"""
+        n = 0
+        for bound, count in zip(self.buckets, self.counts):
+            n += count
+            if n >= q * self.count:
+                return bound
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.latency = {} # stage : Histogram
+            self.per_token = {} # stage : Histogram
+            self.counters = {} # name : n
+            self.failures = {} # (stage, exception type) : n
+            self.last_report = time.time()
+
+    @contextmanager
+    def timer(self, stage, tokens=None, items=1):
+        """
+        Time the block as the given stage, recording its failure if it raises an exception.
+        The yielded dict can be used to set the number of tokens once it is known.
+        If the block processes a batch of items (e.g. articles), set items so the latency
+        is recorded per item, see observe.
+        """
+        info = {"tokens" : tokens, "items" : items}
+        start = time.time()
+        try:
+            yield info
+        except Exception as e:
+            self.fail(stage, e)
+            raise
+        finally:
+            self.observe(stage, time.time() - start, info["tokens"], info["items"])
+
+    def observe(self, stage, seconds, tokens=None, items=1):
+        """
+        Record the latency of the stage. If it processed a batch of items, the average latency
+        per item (and per token) is recorded once for every item.
+        """
+        if not items:
+            return
+        with self.lock:
+            if stage not in self.latency:
+                self.latency[stage] = Histogram(LATENCY_BUCKETS)
+            for i in range(items):
+                self.latency[stage].observe(seconds / items)
+            if tokens:
+                if stage not in self.per_token:
+                    self.per_token[stage] = Histogram(TOKEN_BUCKETS)
+                for i in range(items):
+                    self.per_token[stage].observe(seconds / tokens)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def fail(self, stage, exception):
+        key = (stage, exception.__class__.__name__)
+        with self.lock:
+            self.failures[key] = self.failures.get(key, 0) + 1
+
+    def snapshot(self):
+        """Return the state as a plain (picklable) dict, e.g. to merge metrics of worker processes"""
+        with self.lock:
+            hists = lambda d: {stage : (h.counts, h.sum, h.count) for (stage, h) in d.items()}
+            return {"latency" : hists(self.latency), "per_token" : hists(self.per_token),
+                    "counters" : dict(self.counters), "failures" : dict(self.failures)}
+
+    def merge(self, snapshot):
+        with self.lock:
+            for attr, buckets in ("latency", LATENCY_BUCKETS), ("per_token", TOKEN_BUCKETS):
+                target = getattr(self, attr)
+                for stage, data in snapshot[attr].items():
+                    if stage not in target:
+                        target[stage] = Histogram(buckets)
+                    target[stage].merge(*data)
+            for attr in "counters", "failures":
+                target = getattr(self, attr)
+                for key, n in snapshot[attr].items():
+                    target[key] = target.get(key, 0) + n
+
+    def summary(self):
+        """Return a dict summarizing latency per stage, counters and failures"""
+        with self.lock:
+            stages = {}
+            for stage, h in self.latency.items():
+                stages[stage] = {"n" : h.count, "mean" : round(h.sum / h.count, 4),
+                                 "p50" : h.quantile(.5), "p95" : h.quantile(.95)}
+                if stage in self.per_token:
+                    t = self.per_token[stage]
+                    stages[stage]["mean_per_token"] = round(t.sum / t.count, 6)
+            failures = {"{}:{}".format(*k) : n for (k, n) in self.failures.items()}
+            return {"stages" : stages, "counters" : dict(self.counters), "failures" : failures}
+
+    def report(self, interval=0, path=None):
+        """Log a summary (and write to path, if given) if at least interval seconds passed since the last report"""
+        if time.time() - self.last_report < interval:
+            return
+        self.last_report = time.time()
+        log.info("Metrics: {}".format(json.dumps(self.summary(), sort_keys=True)))
+        if path:
+            self.write(path)
+
+    def to_prometheus(self):
+        """Return the state in the Prometheus text format"""
+        lines = []
+        with self.lock:
+            for name, hists in ("stage_seconds", self.latency), ("stage_seconds_per_token", self.per_token):
+                lines.append("# TYPE amcatxtas_{name} histogram".format(**locals()))
+                for stage, h in sorted(hists.items()):
+                    n = 0
+                    for bound, count in zip(h.buckets, h.counts):
+                        n += count
+                        le = "+Inf" if bound == INF else repr(bound)
+                        lines.append('amcatxtas_{name}_bucket{{stage="{stage}",le="{le}"}} {n}'.format(**locals()))
+                    lines.append('amcatxtas_{name}_sum{{stage="{stage}"}} {h.sum}'.format(**locals()))
+                    lines.append('amcatxtas_{name}_count{{stage="{stage}"}} {h.count}'.format(**locals()))
+            lines.append("# TYPE amcatxtas_events_total counter")
+            for key, n in sorted(self.counters.items()):
+                lines.append('amcatxtas_events_total{{name="{key}"}} {n}'.format(**locals()))
+            lines.append("# TYPE amcatxtas_failures_total counter")
+            for (stage, exception), n in sorted(self.failures.items()):
+                lines.append('amcatxtas_failures_total{{stage="{stage}",exception="{exception}"}} {n}'.format(**locals()))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write the Prometheus text to path (e.g. for the node exporter textfile collector)"""
+        with open(path + ".tmp", "w") as f:
+            f.write(self.to_prometheus())
+        os.rename(path + ".tmp", path)
+
+    def serve(self, port, host=""):
+        """Serve the Prometheus text over http in a background thread"""
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.to_prometheus()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        server = HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+metrics = Metrics()
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+import unittest
+
+class TestMetrics(unittest.TestCase):
+    def test_metrics(self):
+        m = Metrics()
+        with m.timer("parse") as t:
+            t["tokens"] = 10
+        self.assertRaises(ValueError, self._fail, m)
+        m.count("indexed", 3)
+        worker = Metrics()
+        worker.observe("parse", 2.0, tokens=4)
+        m.merge(worker.snapshot())
+
+        s = m.summary()
+        self.assertEqual(s["stages"]["parse"]["n"], 3)
+        self.assertEqual(s["stages"]["parse"]["p95"], 5)
+        self.assertEqual(s["counters"], {"indexed" : 3})
+        self.assertEqual(s["failures"], {"parse:ValueError" : 1})
+        text = m.to_prometheus()
+        self.assertIn('amcatxtas_stage_seconds_bucket{stage="parse",le="+Inf"} 3', text)
+        self.assertIn('amcatxtas_stage_seconds_per_token_count{stage="parse"} 2', text)
+        self.assertIn('amcatxtas_failures_total{stage="parse",exception="ValueError"} 1', text)
+
+    def test_batch(self):
+        m = Metrics()
+        m.observe("process", 40.0, tokens=400, items=4) # a batch of 4 articles
+        s = m.summary()["stages"]["process"]
+        self.assertEqual(s["n"], 4)
+        self.assertEqual(s["p95"], 10)
+
+    def _fail(self, m):
+        with m.timer("parse"):
+            raise ValueError()
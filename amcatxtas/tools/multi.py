@@ -0,0 +1,322 @@
+####################################################################################
+#                          The MIT License (MIT)                                   #
+#                                                                                  #
+# Copyright (c) 2014 Wouter van Atteveldt                                          #
+#                                                                                  #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of  #
+# this software and associated documentation files (the "Software"), to deal in    #
+# the Software without restriction, including without limitation the rights to     #
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of #
+# the Software, and to permit persons to whom the Software is furnished to do so,  #
+# subject to the following conditions:                                             #
+#                                                                                  #
+# The above copyright notice and this permission notice shall be included in all   #
+# copies or substantial portions of the Software.                                  #
+#                                                                                  #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR       #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS #
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR   #
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER   #
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN          #
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.       #
+####################################################################################
+
+"""
+Process a set of articles with several plugins in a single pass.
+
+Articles are selected if the result of any of the plugins is missing, and fetched and
+normalized once. For each article only the plugins without a result are run, and each
+result is stored in the doctype of its plugin by the NLPRunner of that plugin.
+Plugins that declare the same tokenizer (see process_batch) share its output, so the
+text is tokenized once for all of them.
+"""
+
+import logging
+import threading
+log = logging.getLogger(__name__)
+
+from amcatxtas.tools.process_batch import NLPRunner, tokenize_texts, process_texts, ES_INDEX, ES_ARTICLE_DOCTYPE
+from amcatxtas.tools.workqueue import WorkQueue, ESLeaseStore
+from amcatxtas.tools.metrics import metrics
+
+class MultiRunner(object):
+    def __init__(self, runners, leases=None):
+        """
+        runners is a list of NLPRunners, one for each plugin, which should share an elasticsearch client
+        leases is the lease store for the work queue, by default leases are stored in elasticsearch
+        """
+        self.runners = runners
+        self.es = runners[0].es
+        if leases is None:
+            leases = ESLeaseStore(self.es, ES_INDEX, self.doctype + "_lease")
+        self.leases = leases
+        self.queues = {}
+        # articles are done when the results of all runners are indexed, so count the results per article
+        self.outstanding = {} # aid : [setid, number of results not yet indexed (+1 while processing)]
+        self.lock = threading.Lock()
+        for runner in runners:
+            runner.writer.on_done = self.indexed
+
+    @classmethod
+    def create(cls, plugins, **kargs):
+        """Create a MultiRunner with an NLPRunner for each plugin, passing kargs (e.g. format, cache, es) to them"""
+        if kargs.get("es") is None:
+            from amcatxtas.tools.esclient import connect
+            kargs["es"] = connect()
+        return cls([NLPRunner(plugin, **kargs) for plugin in plugins])
+
+    @property
+    def doctype(self):
+        return "__".join(r.doctype for r in self.runners)
+
+    def get_filter(self, setid):
+        """Create a DSL filter dict to filter on set and a missing result for any of the plugins"""
+        return {"bool" : {"should" : [r.get_filter(setid) for r in self.runners]}}
+
+    def get_queue(self, setid):
+        """Return the work queue of articles in this set with missing results"""
+        if setid not in self.queues:
+            prefix = "{setid}_{self.doctype}".format(**locals())
+            self.queues[setid] = WorkQueue(self.es, ES_INDEX, ES_ARTICLE_DOCTYPE, self.get_filter(setid),
+                                           self.leases, prefix)
+        return self.queues[setid]
+
+    def get_articles(self, setid, size=1):
+        """Return one or more articles with missing results from the chunks leased from the set"""
+        queue = self.get_queue(setid)
+        while True:
+            ids = queue.take(size)
+            if not ids:
+                return []
+            with metrics.timer("fetch"):
+                body = {"query" : {"filtered" : {"filter" : {"bool" : {"must" : [
+                    {"ids" : {"values" : ids}}, self.get_filter(setid)]}}}}}
+                result = self.es.search(index=ES_INDEX, doc_type=ES_ARTICLE_DOCTYPE, body=body,
+                                        fields=["headline", "text"], size=len(ids))
+                metrics.count("fetched", len(result['hits']['hits']))
+            queue.done(set(ids) - {int(hit['_id']) for hit in result['hits']['hits']})
+            if result['hits']['hits']:
+                return result['hits']['hits']
+
+    def get_missing(self, aids):
+        """Return a dict of aid : [runners] of the plugins that have no result for the article"""
+        doctypes = [r.doctype for r in self.runners]
+        body = {"query" : {"ids" : {"values" : aids}}}
+        result = self.es.search(index=ES_INDEX, doc_type=",".join(doctypes), body=body, fields=[],
+                                size=len(aids) * len(doctypes))
+        done = {(hit['_type'], str(hit['_id'])) for hit in result['hits']['hits']}
+        return {aid : [r for r in self.runners if (r.doctype, str(aid)) not in done] for aid in aids}
+
+    def process_articles(self, setid, size=1):
+        """Run the missing plugins on one or more articles from the given set"""
+        articles = self.get_articles(setid, size=size)
+        if not articles:
+            return True # done!
+        self.process(setid, articles, self.get_missing([a["_id"] for a in articles]))
+
+    def expect(self, aid):
+        """Count a result for the article that should be indexed before it is done"""
+        with self.lock:
+            self.outstanding[aid][1] += 1
+
+    def indexed(self, aids):
+        """Count the indexed results, reporting articles as done to the work queue when all results are indexed"""
+        done = {} # setid : [aids]
+        with self.lock:
+            for aid in aids:
+                if aid in self.outstanding:
+                    self.outstanding[aid][1] -= 1
+                    if not self.outstanding[aid][1]:
+                        setid, n = self.outstanding.pop(aid)
+                        done.setdefault(setid, []).append(aid)
+        for setid, aids in done.items():
+            self.get_queue(setid).done(aids)
+
+    def process(self, setid, articles, missing):
+        """
+        Run the plugins in missing (aid : [runners]) on the articles and store the results.
+        The articles are reported done to the work queue when all stored results are indexed
+        """
+        with self.lock:
+            for a in articles:
+                self.outstanding[a["_id"]] = [setid, 1]
+        try:
+            self._process(setid, articles, missing)
+        finally:
+            self.indexed([a["_id"] for a in articles])
+
+    def _process(self, setid, articles, missing):
+        texts = {a["_id"] : self.runners[0].get_text(a) for a in articles}
+        todo = {} # runner : [(aid, cache key)]
+        for a in articles:
+            aid = a["_id"]
+            for runner in missing[aid]:
+                key, body = runner.get_cached(texts[aid])
+                if body is None:
+                    todo.setdefault(runner, []).append((aid, key))
+                else:
+                    self.expect(aid)
+                    runner.store(aid, body)
+                    runner.get_progress(setid).add(processed=1)
+                    metrics.count("processed")
+
+        # tokenize each text once per tokenizer, for all plugins that need it
+        tokens = {} # tokenizer : {aid : tokens or exception}
+        for runner, items in todo.items():
+            tokenizer = getattr(runner.plugin, "tokenizer", None)
+            if tokenizer is not None:
+                tokens.setdefault(tokenizer, {}).update((aid, None) for (aid, key) in items)
+        for tokenizer, result in tokens.items():
+            aids = sorted(result)
+            try:
+                result.update(zip(aids, tokenize_texts(tokenizer, [texts[aid] for aid in aids])))
+            except EnvironmentError:
+                # e.g. the tokenizer could not be started, so leave them unprocessed for all plugins that need it
+                log.exception("Exception on tokenizing a batch of {n} articles with {tokenizer}".format(n=len(aids), **locals()))
+                tokens[tokenizer] = None
+
+        for runner, items in todo.items():
+            tokenizer = getattr(runner.plugin, "tokenizer", None)
+            if tokenizer is not None and tokens[tokenizer] is None:
+                metrics.count("batch_failed")
+                continue
+            shared = [tokens[tokenizer][aid] for (aid, key) in items] if tokenizer is not None else None
+            try:
+                with metrics.timer("process", items=len(items)) as t:
+                    results = process_texts(runner.plugin, [texts[aid] for (aid, key) in items], shared)
+                    t["tokens"] = sum(len(getattr(r, "words", ())) for r in results)
+            except Exception:
+                # not a problem of a specific article, so leave them unprocessed for this plugin
+                log.exception("Exception on processing a batch of {n} articles with {runner.doctype}"
+                              .format(n=len(items), **locals()))
+                metrics.count("batch_failed")
+                continue
+            failed = 0
+            for (aid, key), result in zip(items, results):
+                self.expect(aid) # for the result or failure document stored below
+                try:
+                    if isinstance(result, Exception):
+                        raise result
+                    runner.store_result(aid, key, result)
+                    metrics.count("processed")
+                except Exception as e:
+                    log.exception("Exception on processing article {aid} with {runner.doctype}".format(**locals()))
+                    metrics.fail("article", e)
+                    runner.store_failure(aid, "{}: {}".format(type(e).__name__, e))
+                    failed += 1
+            runner.get_progress(setid).add(processed=len(items) - failed, failed=failed)
+
+    def close(self):
+        """Close the runners and release the leases of finished chunks"""
+        for runner in self.runners:
+            runner.close()
+        for queue in self.queues.values():
+            queue.release_all()
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+import unittest
+
+class TestMultiRunner(unittest.TestCase):
+    class FakeRunner(object):
+        class FakeWriter(object):
+            on_done = None
+        def __init__(self, plugin, doctype, stored):
+            self.plugin, self.doctype, self.stored, self.es = plugin, doctype, stored, None
+            self.progress = {"processed" : 0, "failed" : 0}
+            self.writer, self.buffer = self.FakeWriter(), []
+        def get_text(self, article):
+            return article["fields"]["text"]
+        def get_cached(self, text):
+            return None, None
+        def store_result(self, aid, key, result):
+            self.stored[self.doctype, aid] = result
+            self.buffer.append(aid)
+        def store_failure(self, aid, error):
+            self.stored[self.doctype, aid] = {"error" : error}
+            self.buffer.append(aid)
+        def flush(self):
+            self.buffer, aids = [], self.buffer
+            self.writer.on_done(aids)
+        def get_progress(self, setid):
+            return self
+        def add(self, **counts):
+            for k, v in counts.items():
+                self.progress[k] += v
+
+    def test_process(self):
+        tokenized = []
+        def tokenize(text):
+            tokenized.append(text)
+            if text == "fail":
+                raise ValueError(text)
+            return text.upper()
+        class Upper(object):
+            tokenizer = staticmethod(tokenize)
+            @classmethod
+            def process_tokens(cls, tokens):
+                return ["upper " + t for t in tokens]
+        class Length(object):
+            tokenizer = staticmethod(tokenize)
+            @classmethod
+            def process_tokens(cls, tokens):
+                return [len(t) for t in tokens]
+        class Reverse(object):
+            @classmethod
+            def process(cls, text):
+                return text[::-1]
+        class Broken(object):
+            @classmethod
+            def process_batch(cls, texts):
+                raise OSError("cannot start")
+        stored = {}
+        upper, length, reverse, broken = [self.FakeRunner(p, p.__name__, stored) for p in (Upper, Length, Reverse, Broken)]
+        runner = MultiRunner([upper, length, reverse, broken], leases=object())
+        done = []
+        class FakeQueue(object):
+            def done(self, aids):
+                done.extend(aids)
+        runner.queues[1] = FakeQueue()
+        articles = [{"_id" : str(i), "fields" : {"text" : t}} for (i, t) in enumerate(["a b", "fail", "c"])]
+        runner.process(1, articles, {"0" : [upper, length, reverse, broken], "1" : [upper, length], "2" : [reverse]})
+        self.assertEqual(sorted(tokenized), ["a b", "fail"]) # shared, and only if a plugin needs it
+        self.assertEqual(stored[("Upper", "0")], "upper A B")
+        self.assertEqual(stored[("Length", "0")], 3)
+        self.assertEqual(stored[("Reverse", "0")], "b a")
+        self.assertEqual(stored[("Reverse", "2")], "c")
+        self.assertEqual(stored[("Length", "1")], {"error" : "ValueError: fail"})
+        self.assertNotIn(("Reverse", "1"), stored)
+        self.assertEqual(upper.progress, {"processed" : 1, "failed" : 1})
+        self.assertEqual(reverse.progress, {"processed" : 2, "failed" : 0})
+        self.assertEqual(broken.progress, {"processed" : 0, "failed" : 0})
+        self.assertNotIn(("Broken", "0"), stored) # batch failures are not stored
+        self.assertEqual(runner.doctype, "Upper__Length__Reverse__Broken")
+        # articles are done when the results of all their plugins are indexed
+        self.assertEqual(done, [])
+        upper.flush()
+        length.flush()
+        self.assertEqual(done, ["1"])
+        reverse.flush()
+        self.assertEqual(sorted(done), ["0", "1", "2"])
+
+    def test_tokenizer_failure(self):
+        def tokenize(text):
+            raise OSError("cannot start tokenizer")
+        class Upper(object):
+            tokenizer = staticmethod(tokenize)
+            @classmethod
+            def process_tokens(cls, tokens):
+                return ["upper " + t for t in tokens]
+        class Reverse(object):
+            @classmethod
+            def process(cls, text):
+                return text[::-1]
+        stored = {}
+        upper, reverse = [self.FakeRunner(p, p.__name__, stored) for p in (Upper, Reverse)]
+        runner = MultiRunner([upper, reverse], leases=object())
+        articles = [{"_id" : str(i), "fields" : {"text" : t}} for (i, t) in enumerate(["a b", "c"])]
+        runner.process(1, articles, {"0" : [upper, reverse], "1" : [upper, reverse]})
+        self.assertEqual(stored, {("Reverse", "0") : "b a", ("Reverse", "1") : "c"}) # no error documents
+        self.assertEqual(upper.progress, {"processed" : 0, "failed" : 0})
@@ -69,7 +69,7 @@ class NAF_Object(object):
         tag = self.tag or self.__class__.__name__
         fields = self.get_xml_fields()
         map = self.attr_map if self.attr_map is not None else {}
-        kargs = {map.get(k,k): unicode(getattr(self, k)) for k in fields}
+        kargs = {map.get(k,k): getattr(self, k) for k in fields}
         text  = getattr(self, self.text_attr) if self.text_attr else None
         return element(tag, parent=parent, text=text, **kargs)
 
@@ -114,30 +114,85 @@ class Coreference(NAF_Object, namedtuple("Coreference", ["co_id", "spans"])):
 class Coreference_target(NAF_Object, namedtuple("Coreference_target", ["term_id", "head"])):
     pass
 
+class _LazyLayer(object):
+    """
+    Layer of a NAF_Article that is only created on first access, by calling the function
+    set with set_layer, or as an empty list. After that it is a normal instance attribute.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, article, cls):
+        if article is None:
+            return self
+        function, data = article._raw.pop(self.name, (None, None))
+        value = [] if function is None else function(data)
+        setattr(article, self.name, value)
+        return value
+
 class NAF_Article(object):
+    LAYERS = ["words", "terms", "entities", "dependencies", "coreferences", "trees", "frames", "fixed_frames"]
+
+    words = _LazyLayer("words")
+    terms = _LazyLayer("terms")
+    entities = _LazyLayer("entities")
+    dependencies = _LazyLayer("dependencies")
+    coreferences = _LazyLayer("coreferences")
+    trees = _LazyLayer("trees")
+    frames = _LazyLayer("frames")
+    fixed_frames = _LazyLayer("fixed_frames")
+
     def __init__(self):
         self.sentences = []
-        self.words = []
-        self.terms = []
-        self.entities = []
-        self.dependencies = []
-        self.coreferences = []
-        self.trees = []
-        self.frames = []
-        self.fixed_frames = []
+        self._raw = {} # layer : (function, data), see set_layer
 
-    def get_word(self, word_id):
+    def set_layer(self, name, function, data):
+        """Set the layer to function(data), which is only called on first access if the layer is lazy"""
+        if isinstance(getattr(type(self), name, None), _LazyLayer):
+            self.__dict__.pop(name, None)
+            self._raw[name] = (function, data)
+        else:
+            setattr(self, name, function(data))
+
+    def _get_index(self, name, attr, key, unique=True):
+        """
+        Return a dict key(object) : object (or : [objects] if not unique) for the objects in getattr(self, attr)
+        The index is built on first use and extended with objects appended to the list since.
+        It is rebuilt if the list is replaced or shortened (also if it was extended again since, which is
+        detected by checking the last indexed object), but not if an object is replaced in place.
+        """
         try:
-            d = self.__word_dict
+            indexes = self.__indexes
         except AttributeError:
-            d = self.__word_dict = {w.word_id : w for w in self.words}
-        return d[word_id]
+            indexes = self.__indexes = {}
+        objects = getattr(self, attr)
+        entry = indexes.get(name) # [list, number of indexed objects, index, last indexed object]
+        if (entry is None or entry[0] is not objects or entry[1] > len(objects)
+                or (entry[1] and objects[entry[1] - 1] is not entry[3])):
+            entry = indexes[name] = [objects, 0, {}, None]
+        n, index = entry[1], entry[2]
+        if n < len(objects):
+            for obj in objects[n:]:
+                if unique:
+                    index[key(obj)] = obj
+                else:
+                    index.setdefault(key(obj), []).append(obj)
+            entry[1], entry[3] = len(objects), objects[-1]
+        return index
+
+    def get_word(self, word_id):
+        return self._get_index("word", "words", lambda w: w.word_id)[word_id]
         
     def term(self, term_id):
-        for term in self.terms:
-            if term.term_id == term_id:
-                return term
-        raise ValueError("Term {term_id} not found".format(**locals()))
+        try:
+            return self._get_index("term", "terms", lambda t: t.term_id)[term_id]
+        except KeyError:
+            raise ValueError("Term {term_id} not found".format(**locals()))
+
+    def get_sentence_terms(self, sentence_id):
+        """Return the terms in the given sentence, based on the sentence of their first word"""
+        index = self._get_index("sentence_terms", "terms", lambda t: self.get_word(t.word_ids[0]).sentence_id, unique=False)
+        return index.get(sentence_id, [])
         
     @property
     def sentence_ids(self):
@@ -164,9 +219,13 @@ class NAF_Article(object):
         [dep.generate_xml(parent=deps) for dep in self.dependencies]
         return root
 
+    def write_xml(self, output, **attrs):
+        """Write this article as NAF to output (a file name or file-like object) without building the tree"""
+        with NAFWriter(output) as writer:
+            writer.write(self, **attrs)
+
     def to_dict(self):
-        return {k : getattr(self, k)
-                for k in ["words", "terms", "entities", "dependencies", "coreferences", "trees", "frames", "fixed_frames"]}
+        return {k : getattr(self, k) for k in self.LAYERS}
 
     def to_json(self, **kargs):
         """
@@ -177,7 +236,7 @@ class NAF_Article(object):
     @classmethod
     def from_dict(cls, d):
         """
-        Reconstruct a NAF Article from a dict
+        Reconstruct a NAF Article from a dict. Layers are converted to objects on first access.
         """
         result = cls()
         for attr, target_class in [("words", WordForm),
@@ -186,8 +245,7 @@ class NAF_Article(object):
                                    ("dependencies", Dependency),
                                    ]:
             if attr not in d: continue
-            objects = [target_class(**data) for data in d[attr]]
-            setattr(result, attr, objects)
+            result.set_layer(attr, lambda data, target_class=target_class: [target_class(**x) for x in data], d[attr])
         return result
             
         
@@ -197,22 +255,65 @@ class NAF_Article(object):
         a = cls()
         d = json.loads(json_string)
         for attr, target_class in ("words", WordForm), ("terms", Term), ("entities", Entity), ("dependencies", Dependency):
-            val = [target_class(*data) for data in d[attr]]
-            setattr(a, attr, val)
+            a.set_layer(attr, lambda data, target_class=target_class: [target_class(*x) for x in data], d[attr])
         a.trees = d["trees"]
         a.frames = d.get("frames", [])
         a.fixed_frames = d.get("fixed_frames", [])
-        a.coreferences = [Coreference_target(co_id, [[Coreference_target(*s) for s in targets]
-                                                     for targets in spans])
-                          for co_id, spans in d["coreferences"]]
+        a.set_layer("coreferences", lambda data: [Coreference_target(co_id, [[Coreference_target(*s) for s in targets]
+                                                                             for targets in spans])
+                                                  for co_id, spans in data], d["coreferences"])
         return a
 
     def get_children(self, term):
         if isinstance(term, Term): term = term.term_id
-        for dep in self.dependencies:
-            if dep.from_term == term:
-                yield dep
+        return iter(self._get_index("children", "dependencies", lambda d: d.from_term, unique=False).get(term, []))
+
+    def get_parents(self, term):
+        if isinstance(term, Term): term = term.term_id
+        return iter(self._get_index("parents", "dependencies", lambda d: d.to_term, unique=False).get(term, []))
     
+class NAFWriter(object):
+    """
+    Incrementally write NAF xml to a file name or file-like object (e.g. a socket file).
+    Only the element of a single word, term or dependency is in memory at any time.
+    In corpus mode, many articles are written inside a single NAFCorpus root element.
+    Use as a context manager, or call close to finish the document.
+    """
+    def __init__(self, output, corpus=False, encoding="utf-8"):
+        self._xmlfile = etree.xmlfile(output, encoding=encoding)
+        self.xf = self._xmlfile.__enter__()
+        self.xf.write_declaration()
+        self._root = self.xf.element("NAFCorpus") if corpus else None
+        if self._root is not None:
+            self._root.__enter__()
+
+    def write(self, article, **attrs):
+        """Write the article as a NAF element with the given attributes (e.g. id)"""
+        xf = self.xf
+        with xf.element("NAF", {k : unicode(v) for (k, v) in attrs.iteritems()}):
+            for tag, objects in ("text", article.words), ("terms", article.terms), ("deps", article.dependencies):
+                with xf.element(tag):
+                    for obj in objects:
+                        xf.write(obj.generate_xml())
+        xf.flush()
+
+    def close(self):
+        if self._root is not None:
+            self._root.__exit__(None, None, None)
+        self._xmlfile.__exit__(None, None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def write_corpus(articles, output):
+    """Write the (aid, article) pairs, e.g. from a generator, as a NAF corpus"""
+    with NAFWriter(output, corpus=True) as writer:
+        for aid, article in articles:
+            writer.write(article, id=aid)
+
 class Sentence(object):
     """
     Helper object. Sentences are not a NAF primitive, but since terms
@@ -232,8 +333,10 @@ class Sentence(object):
         """
         word_id = len(self.article.words) + 1
         term_id = len(self.article.terms) + 1
-        word = WordForm(word_id, self.sentence_id, int(offset), word)
-        term = Term(term_id, [word_id], lemma, pos, extra=term_extra)
+        # _make bypasses the keyword handling in NAF_Object.__new__, which is
+        # relatively expensive for something called for every token
+        word = WordForm._make((word_id, self.sentence_id, int(offset), word, {}))
+        term = Term._make((term_id, [word_id], lemma, pos, term_extra or {}))
         self.article.words.append(word)
         self.article.terms.append(term)
         self.terms.append(term)
@@ -244,7 +347,7 @@ class Sentence(object):
         return term
         
     def add_dependency(self, from_term, to_term, rfunc):
-        dep = Dependency(from_term, to_term, rfunc)
+        dep = Dependency._make((from_term, to_term, rfunc, {}))
         self.article.dependencies.append(dep)
 
 ###########################################################################
@@ -267,4 +370,75 @@ class TestNAF(unittest.TestCase):
         self.assertEqual(w.test2, "bla")
         self.assertEqual(json.dumps(w), '[1, 2, 3, "test", {"test1": 1, "test2": "bla"}]')
 
-        
+    def test_indexes(self):
+        a = NAF_Article()
+        s = a.create_sentence()
+        t1 = s.add_word(0, "Jan", "jan", "M")
+        t2 = s.add_word(1, "slaapt", "slapen", "V")
+        s.add_dependency(t2.term_id, t1.term_id, "su")
+        self.assertEqual(a.term(1), t1)
+        self.assertEqual(a.get_word(2).word, "slaapt")
+        self.assertEqual([d.to_term for d in a.get_children(t2)], [1])
+        self.assertEqual(list(a.get_parents(t2)), [])
+
+        # indexes should be extended when words and dependencies are added
+        s = a.create_sentence()
+        t3 = s.add_word(0, "Piet", "piet", "M")
+        s.add_dependency(t2.term_id, t3.term_id, "obj1")
+        self.assertEqual(a.term(3), t3)
+        self.assertEqual(a.get_word(3).word, "Piet")
+        self.assertEqual([d.to_term for d in a.get_children(t2)], [1, 3])
+        self.assertEqual([d.from_term for d in a.get_parents(t3)], [2])
+        self.assertEqual(a.get_sentence_terms(1), [t1, t2])
+        self.assertEqual(a.get_sentence_terms(2), [t3])
+        self.assertRaises(ValueError, a.term, 4)
+
+        # and rebuilt if the list is replaced or shortened
+        del a.terms[2:]
+        self.assertRaises(ValueError, a.term, 3)
+        a.terms = [t3]
+        self.assertRaises(ValueError, a.term, 1)
+        self.assertEqual(a.term(3), t3)
+
+        # or shortened and extended again before the next lookup
+        a.terms = [t1, t2]
+        self.assertEqual(a.term(2), t2)
+        del a.terms[1:]
+        t4 = s.add_word(1, "Kees", "kees", "M")
+        self.assertEqual(t4.term_id, 2)
+        self.assertEqual(a.term(2), t4)
+
+    def test_lazy_layers(self):
+        a = NAF_Article()
+        s = a.create_sentence()
+        s.add_word(0, "Jan", "jan", "M", term_extra={"major" : "name"})
+        s.add_word(1, "slaapt", "slapen", "V")
+        s.add_dependency(2, 1, "su")
+        b = NAF_Article.from_json(a.to_json())
+        self.assertIn("terms", b._raw)
+        self.assertEqual(b.terms, a.terms)
+        self.assertNotIn("terms", b._raw)
+        self.assertIn("dependencies", b._raw) # not needed yet
+        self.assertEqual(b.to_json(), a.to_json())
+        # assigning replaces the lazy layer
+        b = NAF_Article.from_dict({"words" : [w._asdict() for w in a.words]})
+        b.words = []
+        self.assertEqual((b.words, b.terms), ([], []))
+
+    def test_write_xml(self):
+        from StringIO import StringIO
+        a = NAF_Article()
+        s = a.create_sentence()
+        t1 = s.add_word(0, u"J\xe1n", "jan", "M", term_extra={"major" : "name"})
+        t2 = s.add_word(1, "slaapt", "slapen", "V")
+        s.add_dependency(t2.term_id, t1.term_id, "su")
+
+        out = StringIO()
+        a.write_xml(out)
+        self.assertEqual(etree.tostring(etree.fromstring(out.getvalue())), etree.tostring(a.generate_xml()))
+
+        out = StringIO()
+        write_corpus(((aid, a) for aid in [1, 2]), out)
+        corpus = etree.fromstring(out.getvalue())
+        self.assertEqual([naf.get("id") for naf in corpus], ["1", "2"])
+        self.assertEqual(etree.tostring(corpus[1]), etree.tostring(a.generate_xml()).replace("<NAF>", '<NAF id="2">'))
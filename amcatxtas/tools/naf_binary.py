@@ -0,0 +1,245 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+
+"""
+Compact binary serialization of NAF articles.
+
+The format is a header followed by independently decodable layers:
+
+  header: "NAFB", version (byte), number of layers (uint16),
+          and per layer its name (length prefixed), offset and length (uint32)
+  strings: all strings and extra values of the article, see encode_strings
+  words, terms, dependencies: int32 columns as used by naf_compact, followed by
+          the sparse extra attributes (keys, and rows and values per key)
+  entities, coreferences, trees, frames, fixed_frames: json
+
+All integers are little endian. Column layers are decoded directly into the arrays
+of a CompactArticle, and only the requested layers are decoded.
+"""
+
+import base64
+import json
+import struct
+import sys
+from array import array
+
+from .naf import Entity, Coreference, Coreference_target
+from .naf_compact import CompactArticle, StringTable, WordColumns, TermColumns, DependencyColumns
+
+MAGIC = "NAFB"
+VERSION = 1
+
+COLUMN_LAYERS = [("words", WordColumns, ["word_ids", "sentence_ids", "offsets", "words"]),
+                 ("terms", TermColumns, ["term_ids", "lemmas", "pos", "spans", "word_ids"]),
+                 ("dependencies", DependencyColumns, ["from_terms", "to_terms", "rfuncs"])]
+JSON_LAYERS = ["entities", "coreferences", "trees", "frames", "fixed_frames"]
+
+# type tags of the values in the string table
+STRING, NONE, JSON = 0, 1, 2
+
+def _pack_ints(values):
+    a = array('i', values)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return struct.pack("<I", len(a)) + a.tostring()
+
+def _unpack_ints(data, pos):
+    """Return the int array at pos and the position after it"""
+    n, = struct.unpack_from("<I", data, pos)
+    pos += 4
+    a = array('i')
+    a.fromstring(buffer(data, pos, 4 * n))
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a, pos + 4 * n
+
+def encode_strings(strings):
+    """Encode the values as type tags, byte lengths and the concatenated utf-8 or json bytes"""
+    tags, lengths, parts = [], [], []
+    for value in strings:
+        if value is None:
+            tag, value = NONE, ""
+        elif isinstance(value, unicode):
+            tag, value = STRING, value.encode("utf-8")
+        elif isinstance(value, str):
+            tag = STRING
+        else:
+            tag, value = JSON, json.dumps(value)
+        tags.append(tag)
+        lengths.append(len(value))
+        parts.append(value)
+    return _pack_ints(tags) + _pack_ints(lengths) + "".join(parts)
+
+def decode_strings(data):
+    tags, pos = _unpack_ints(data, 0)
+    lengths, pos = _unpack_ints(data, pos)
+    values = []
+    for tag, length in zip(tags, lengths):
+        value = data[pos:pos+length]
+        pos += length
+        if tag == STRING:
+            values.append(value.decode("utf-8"))
+        elif tag == NONE:
+            values.append(None)
+        else:
+            values.append(json.loads(value))
+    return values
+
+def encode_columns(columns, fields):
+    parts = [_pack_ints(getattr(columns, f)) for f in fields]
+    keys = sorted(columns.extras.columns)
+    parts.append(_pack_ints([columns.strings.intern(k) for k in keys]))
+    for k in keys:
+        rows, values = columns.extras.columns[k]
+        parts += [_pack_ints(rows), _pack_ints(values)]
+    return "".join(parts)
+
+def decode_columns(data, columns, fields):
+    pos = 0
+    for f in fields:
+        a, pos = _unpack_ints(data, pos)
+        setattr(columns, f, a)
+    columns.n = len(getattr(columns, fields[0]))
+    keys, pos = _unpack_ints(data, pos)
+    for k in keys:
+        rows, pos = _unpack_ints(data, pos)
+        values, pos = _unpack_ints(data, pos)
+        columns.extras.columns[columns.strings[k]] = (rows, values)
+    return columns
+
+def encode(article):
+    """Encode the article (any NAF_Article) in the binary format"""
+    strings = StringTable()
+    compact = CompactArticle(strings)
+    layers = []
+    for name, cls, fields in COLUMN_LAYERS:
+        setattr(compact, name, getattr(article, name))
+        layers.append((name, encode_columns(getattr(compact, name), fields)))
+    for name in JSON_LAYERS:
+        layers.append((name, json.dumps(getattr(article, name))))
+    layers.insert(0, ("strings", encode_strings(strings.values)))
+
+    header = MAGIC + struct.pack("<BH", VERSION, len(layers))
+    header_size = len(header) + sum(1 + len(name) + 8 for (name, data) in layers)
+    offset = header_size
+    for name, data in layers:
+        header += struct.pack("<B", len(name)) + name + struct.pack("<II", offset, len(data))
+        offset += len(data)
+    return header + "".join(data for (name, data) in layers)
+
+def read_header(data):
+    """Return a dict of layer name : (offset, length)"""
+    if data[:4] != MAGIC:
+        raise ValueError("Not a binary NAF article")
+    version, n = struct.unpack_from("<BH", data, 4)
+    if version != VERSION:
+        raise ValueError("Unsupported binary NAF version {version}".format(**locals()))
+    pos, layers = 7, {}
+    for i in range(n):
+        length, = struct.unpack_from("<B", data, pos)
+        name = data[pos+1:pos+1+length]
+        layers[name] = struct.unpack_from("<II", data, pos+1+length)
+        pos += 1 + length + 8
+    return layers
+
+def decode(data, layers=None):
+    """
+    Decode the binary data as a CompactArticle. If layers is given, only those layers are decoded,
+    other layers are left empty. The json layers are only decoded on first access.
+    """
+    header = read_header(data)
+    def layer(name):
+        offset, length = header[name]
+        return buffer(data, offset, length)
+
+    article = CompactArticle(StringTable.from_values(decode_strings(layer("strings"))))
+    for name, cls, fields in COLUMN_LAYERS:
+        if layers is None or name in layers:
+            setattr(article, "_" + name, decode_columns(layer(name), cls(article.strings), fields))
+    for name in JSON_LAYERS:
+        if layers is None or name in layers:
+            article.set_layer(name, _JSON_DECODERS.get(name, json.loads), str(layer(name)))
+    return article
+
+_JSON_DECODERS = {
+    "entities" : lambda data: [Entity(*e) for e in json.loads(data)],
+    "coreferences" : lambda data: [Coreference(co_id, [[Coreference_target(*t) for t in targets] for targets in spans])
+                                   for (co_id, spans) in json.loads(data)],
+    }
+
+def serialize(article):
+    """Serialize the article as a dict that can be stored in elasticsearch"""
+    return {"naf_binary" : base64.b64encode(encode(article))}
+
+def deserialize(body, layers=None):
+    return decode(base64.b64decode(body["naf_binary"]), layers)
+
+def benchmark(n_sentences=1000, n_words=20, repeat=5):
+    """Time json and binary encoding and decoding of a synthetic article, returning a dict of timings"""
+    import timeit
+    from .naf import NAF_Article
+    article = NAF_Article()
+    for i in range(n_sentences):
+        s = article.create_sentence()
+        terms = [s.add_word(j, u"woord{}".format(j), u"lemma{}".format(j % 50), "N",
+                            term_extra={"major" : "noun", "minor" : None}) for j in range(n_words)]
+        for t in terms[1:]:
+            s.add_dependency(t.term_id, terms[0].term_id, "mod")
+    js, binary = article.to_json(), encode(article)
+    tests = {"json_encode" : lambda: article.to_json(),
+             "json_decode" : lambda: NAF_Article.from_json(js),
+             "binary_encode" : lambda: encode(article),
+             "binary_decode" : lambda: decode(binary),
+             "binary_decode_words" : lambda: decode(binary, layers=["words"]),
+             "binary_decode_objects" : lambda: list(decode(binary).terms)}
+    result = {name : min(timeit.repeat(f, number=1, repeat=repeat)) for (name, f) in tests.items()}
+    result.update(json_bytes=len(js), binary_bytes=len(binary))
+    return result
+
+if __name__ == '__main__':
+    for k, v in sorted(benchmark().items()):
+        print "{k:25s} {v}".format(**locals())
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+import unittest
+
+class TestBinary(unittest.TestCase):
+    def test_roundtrip(self):
+        from .naf import NAF_Article
+        a = NAF_Article()
+        s = a.create_sentence()
+        t1 = s.add_word(0, u"J\xe1n", u"j\xe1n", "M", entity_type="PER", term_extra={"major" : "name", "n" : 3})
+        t2 = s.add_word(1, u"slaapt", u"slapen", "V", term_extra={"major" : "verb", "minor" : None})
+        s.add_dependency(t2.term_id, t1.term_id, "su")
+        a.create_coreference([[Coreference_target(1, True)]])
+        a.trees = ["(S (N Jan) (V slaapt))"]
+
+        b = deserialize(json.loads(json.dumps(serialize(a))))
+        for attr in "words", "terms", "dependencies", "entities", "coreferences", "trees", "frames":
+            self.assertEqual(list(getattr(b, attr)), getattr(a, attr))
+        self.assertEqual(b.terms[0].n, 3)
+        self.assertEqual(b.term(2).minor, None)
+
+        b = decode(encode(a), layers=["terms"])
+        self.assertEqual(list(b.terms), a.terms)
+        self.assertEqual(len(b.words), 0)
+        self.assertRaises(ValueError, decode, "NAF")
@@ -0,0 +1,258 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+
+"""
+Compact, column based representation of NAF articles.
+
+Words, terms and dependencies are stored in typed arrays, with all strings (and
+other extra values) interned in a string table that can be shared between articles.
+Extra attributes are stored sparsely per key. The words, terms and dependencies
+attributes are still sequences of WordForm, Term and Dependency objects, but these
+are created when they are accessed. Ids, offsets and sentence ids should be integers.
+"""
+
+from array import array
+from bisect import bisect_left
+from collections import Sequence
+
+from .naf import NAF_Article, WordForm, Term, Dependency
+
+class StringTable(object):
+    """Table of interned values, which can be shared between articles"""
+    def __init__(self):
+        self.values = []
+        self.ids = {}
+
+    @classmethod
+    def from_values(cls, values):
+        """Create a table containing the (unique) values in order"""
+        table = cls()
+        table.values = values
+        for id, value in enumerate(values):
+            try:
+                table.ids[value] = id
+            except TypeError:
+                pass
+        return table
+
+    def intern(self, value):
+        try:
+            return self.ids[value]
+        except KeyError:
+            id = self.ids[value] = len(self.values)
+        except TypeError: # unhashable values are stored without interning
+            id = len(self.values)
+        self.values.append(value)
+        return id
+
+    def __getitem__(self, id):
+        return self.values[id]
+
+    def __len__(self):
+        return len(self.values)
+
+# table shared by all compact articles that don't specify a table
+STRINGS = StringTable()
+
+class Extras(object):
+    """Sparse extra attributes, stored per key as arrays of row numbers and value ids"""
+    def __init__(self, strings):
+        self.strings = strings
+        self.columns = {} # key : (rows, values)
+
+    def add(self, row, extra):
+        if not extra:
+            return
+        for k, v in extra.iteritems():
+            if k not in self.columns:
+                self.columns[k] = (array('i'), array('i'))
+            rows, values = self.columns[k]
+            rows.append(row)
+            values.append(self.strings.intern(v))
+
+    def get(self, row):
+        result = {}
+        for k, (rows, values) in self.columns.iteritems():
+            i = bisect_left(rows, row)
+            if i < len(rows) and rows[i] == row:
+                result[k] = self.strings[values[i]]
+        return result
+
+class Columns(Sequence):
+    """Base class for column based sequences of NAF objects, supporting append and extend"""
+    def __init__(self, strings):
+        self.strings = strings
+        self.extras = Extras(strings)
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.get(j) for j in range(*i.indices(self.n))]
+        if i < 0:
+            i += self.n
+        if not 0 <= i < self.n:
+            raise IndexError(i)
+        return self.get(i)
+
+    def append(self, obj):
+        self.add(obj)
+        self.extras.add(self.n, obj.extra)
+        self.n += 1
+
+    def extend(self, objects):
+        for obj in objects:
+            self.append(obj)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<{} of {} {}>".format(self.__class__.__name__, self.n, self.cls.__name__)
+
+class WordColumns(Columns):
+    cls = WordForm
+
+    def __init__(self, strings):
+        super(WordColumns, self).__init__(strings)
+        self.word_ids, self.sentence_ids, self.offsets, self.words = (array('i') for i in range(4))
+
+    def add(self, w):
+        self.word_ids.append(w.word_id)
+        self.sentence_ids.append(w.sentence_id)
+        self.offsets.append(w.offset)
+        self.words.append(self.strings.intern(w.word))
+
+    def get(self, i):
+        return WordForm(self.word_ids[i], self.sentence_ids[i], self.offsets[i],
+                        self.strings[self.words[i]], self.extras.get(i))
+
+class TermColumns(Columns):
+    cls = Term
+
+    def __init__(self, strings):
+        super(TermColumns, self).__init__(strings)
+        self.term_ids, self.lemmas, self.pos = (array('i') for i in range(3))
+        # word ids of term i are word_ids[spans[i]:spans[i+1]]
+        self.spans, self.word_ids = array('i', [0]), array('i')
+
+    def add(self, t):
+        self.term_ids.append(t.term_id)
+        self.word_ids.extend(t.word_ids)
+        self.spans.append(len(self.word_ids))
+        self.lemmas.append(self.strings.intern(t.lemma))
+        self.pos.append(self.strings.intern(t.pos))
+
+    def get(self, i):
+        word_ids = list(self.word_ids[self.spans[i]:self.spans[i+1]])
+        return Term(self.term_ids[i], word_ids, self.strings[self.lemmas[i]], self.strings[self.pos[i]],
+                    self.extras.get(i))
+
+class DependencyColumns(Columns):
+    cls = Dependency
+
+    def __init__(self, strings):
+        super(DependencyColumns, self).__init__(strings)
+        self.from_terms, self.to_terms, self.rfuncs = (array('i') for i in range(3))
+
+    def add(self, d):
+        self.from_terms.append(d.from_term)
+        self.to_terms.append(d.to_term)
+        self.rfuncs.append(self.strings.intern(d.rfunc))
+
+    def get(self, i):
+        return Dependency(self.from_terms[i], self.to_terms[i], self.strings[self.rfuncs[i]], self.extras.get(i))
+
+def _columns_property(attr, columns_class):
+    """Property that converts assigned sequences to columns"""
+    def get(self):
+        return getattr(self, "_" + attr)
+    def set(self, objects):
+        columns = columns_class(self.strings)
+        columns.extend(objects)
+        setattr(self, "_" + attr, columns)
+    return property(get, set)
+
+class CompactArticle(NAF_Article):
+    """
+    NAF_Article that stores its words, terms and dependencies in columns.
+    Articles can be converted with from_article, and from_dict and from_json
+    create compact articles when called on this class.
+    """
+    words = _columns_property("words", WordColumns)
+    terms = _columns_property("terms", TermColumns)
+    dependencies = _columns_property("dependencies", DependencyColumns)
+
+    def __init__(self, strings=None):
+        self.strings = STRINGS if strings is None else strings
+        super(CompactArticle, self).__init__()
+        self.words, self.terms, self.dependencies = [], [], []
+
+    @classmethod
+    def from_article(cls, article, strings=None):
+        result = cls(strings)
+        for attr, value in article.__dict__.items():
+            if not attr.startswith("_"):
+                setattr(result, attr, value)
+        for attr in article.LAYERS:
+            setattr(result, attr, getattr(article, attr))
+        return result
+
+    def to_dict(self):
+        d = super(CompactArticle, self).to_dict()
+        for attr in "words", "terms", "dependencies":
+            d[attr] = list(d[attr])
+        return d
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+import unittest
+
+class TestCompactArticle(unittest.TestCase):
+    def test_roundtrip(self):
+        a = NAF_Article()
+        s = a.create_sentence()
+        t1 = s.add_word(0, "Jan", "jan", "M", term_extra={"major" : "name"})
+        t2 = s.add_word(1, "slaapt", "slapen", "V", term_extra={"major" : "verb", "minor" : None})
+        s.add_dependency(t2.term_id, t1.term_id, "su")
+
+        strings = StringTable()
+        c = CompactArticle.from_article(a, strings)
+        self.assertEqual(list(c.words), a.words)
+        self.assertEqual(list(c.terms), a.terms)
+        self.assertEqual(list(c.dependencies), a.dependencies)
+        self.assertEqual(c.terms[-1].minor, None)
+        self.assertRaises(AttributeError, getattr, c.terms[0], "minor")
+        self.assertEqual(c.to_json(sort_keys=True), a.to_json(sort_keys=True))
+        self.assertEqual(CompactArticle.from_json(a.to_json()).terms, a.terms)
+
+        # strings are shared, sentences can be added
+        n = len(strings)
+        c2 = CompactArticle.from_article(a, strings)
+        self.assertEqual(len(strings), n)
+        c2.create_sentence().add_word(0, "Piet", "piet", "M")
+        self.assertEqual(c2.term(3).lemma, "piet")
+        self.assertEqual(len(c2.words), 3)
@@ -0,0 +1,277 @@
+####################################################################################
+#                          The MIT License (MIT)                                   #
+#                                                                                  #
+# Copyright (c) 2014 Wouter van Atteveldt                                          #
+#                                                                                  #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of  #
+# this software and associated documentation files (the "Software"), to deal in    #
+# the Software without restriction, including without limitation the rights to     #
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of #
+# the Software, and to permit persons to whom the Software is furnished to do so,  #
+# subject to the following conditions:                                             #
+#                                                                                  #
+# The above copyright notice and this permission notice shall be included in all   #
+# copies or substantial portions of the Software.                                  #
+#                                                                                  #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR       #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS #
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR   #
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER   #
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN          #
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.       #
+####################################################################################
+
+"""
+Process a set of articles with a pool of worker processes.
+
+The parent process fetches the articles (using the work queue of an NLPRunner), looks
+them up in its cache and stores the results (using its bulk writer), the workers only
+run the plugin.
+Each worker imports the plugin once, so state such as an Alpino pool is reused.
+"""
+
+import signal
+import time
+import traceback
+import multiprocessing
+import logging
+log = logging.getLogger(__name__)
+
+from amcatxtas.tools.process_batch import import_attribute, process_texts, FORMATS
+from amcatxtas.tools.metrics import metrics
+
+_plugin = None
+_serialize = None
+
+def _init_worker(plugin, format):
+    """Import the plugin in this worker, and leave handling of ctrl-c to the parent"""
+    global _plugin, _serialize
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL) # so the pool can terminate the worker
+    _plugin = import_attribute(plugin)
+    _serialize = FORMATS[format] or _plugin.serialize
+
+def _process(items):
+    """
+    Process the (aid, text) pairs in a worker, returning a list of (aid, result, error) triples
+    and a snapshot of the worker metrics
+    """
+    output = process_items(_plugin, _serialize, items)
+    snapshot = metrics.snapshot()
+    metrics.reset()
+    return output, snapshot
+
+def process_items(plugin, serialize, items):
+    """
+    Process the (aid, text) pairs with the plugin and serialize the results, returning
+    a list of (aid, serialized result, error) triples, where error is a formatted traceback.
+    Exceptions for the batch as a whole (e.g. the parser could not be started) are raised,
+    as they should not be stored as failures of the articles.
+    """
+    with metrics.timer("process", items=len(items)) as t:
+        results = process_texts(plugin, [text for (aid, text) in items])
+        t["tokens"] = sum(len(getattr(r, "words", ())) for r in results)
+    output = []
+    for (aid, text), result in zip(items, results):
+        body, error = None, None
+        try:
+            if isinstance(result, Exception):
+                raise result
+            with metrics.timer("serialize"):
+                body = serialize(result)
+        except Exception:
+            error = traceback.format_exc()
+        output.append((aid, body, error))
+    return output
+
+class ParallelRunner(object):
+    """
+    Run the plugin of an NLPRunner over a set using a pool of worker processes.
+    On SIGINT or SIGTERM no new articles are fetched, and the articles in progress
+    are finished and stored before returning. A second signal stops immediately.
+    """
+    def __init__(self, runner, plugin, workers, report_interval=60, metrics_interval=60, metrics_file=None,
+                 timeout=7200):
+        """
+        plugin should be the name of the plugin of the runner, e.g. amcatxtas.plugins.alpino.AlpinoPlugin
+        Metrics of the workers are merged into the metrics of this process, and reported every metrics_interval
+        Batches that fail as a whole, or do not return within timeout seconds (e.g. because the worker died),
+        are counted as batch_failed, and their articles are left unprocessed (and not counted as failed)
+        """
+        self.runner = runner
+        self.plugin = plugin
+        self.workers = workers
+        self.timeout = timeout
+        self.report_interval = report_interval
+        self.metrics_interval = metrics_interval
+        self.metrics_file = metrics_file
+        self.stopped = False
+        self.done = 0
+        self.failed = 0
+        self.lost_batches = 0
+
+    def stop(self, signum, frame):
+        if self.stopped:
+            raise KeyboardInterrupt()
+        log.warn("Received signal {signum}, finishing articles in progress".format(**locals()))
+        self.stopped = True
+
+    def run(self, setid, size=1, number=None):
+        """Process the set in batches of size articles, until it is done or after number batches"""
+        # create the pool first, so the workers do not inherit the signal handlers
+        pool = multiprocessing.Pool(self.workers, _init_worker, (self.plugin, self.runner.format))
+        handlers = {s : signal.signal(s, self.stop) for s in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            self._run(pool, setid, size, number)
+            if self.lost_batches:
+                pool.terminate() # join would wait for the lost batches
+            else:
+                pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            for s, handler in handlers.items():
+                signal.signal(s, handler)
+            self.runner.close()
+        self.report()
+        metrics.report(path=self.metrics_file)
+
+    def _run(self, pool, setid, size, number):
+        keys = {} # aid : cache key
+        pending = [] # (async result, aids, deadline) of the batches given to the workers
+        in_flight, batches, exhausted = 0, 0, False
+        self.start = last_report = time.time()
+        while True:
+            # keep the workers busy by having (at least) twice as many batches in flight
+            if not (exhausted or self.stopped) and in_flight < 2 * self.workers * size:
+                articles = self.runner.get_articles(setid, size=size)
+                batches += 1
+                exhausted = not articles or (number is not None and batches >= number)
+                todo = [] # the uncached articles of the batch are processed by one worker
+                for a in articles:
+                    text = self.runner.get_text(a)
+                    key, body = self.runner.get_cached(text)
+                    if body is not None:
+                        self.store(setid, a["_id"], body, None)
+                    else:
+                        keys[a["_id"]] = key
+                        todo.append((a["_id"], text))
+                if todo:
+                    result = pool.apply_async(_process, (todo,))
+                    pending.append((result, [aid for (aid, text) in todo], time.time() + self.timeout))
+                    in_flight += len(todo)
+                continue
+            if not pending:
+                break
+            pending[0][0].wait(1)
+            waiting = []
+            for result, aids, deadline in pending:
+                if not (result.ready() or time.time() > deadline):
+                    waiting.append((result, aids, deadline))
+                    continue
+                in_flight -= len(aids)
+                try:
+                    output, snapshot = result.get(0)
+                except Exception as e:
+                    self.lost(aids, e)
+                    for aid in aids:
+                        keys.pop(aid, None)
+                    continue
+                metrics.merge(snapshot)
+                for aid, body, error in output:
+                    self.store(setid, aid, body, error, keys.pop(aid, None))
+            pending = waiting
+            if time.time() - last_report > self.report_interval:
+                self.report()
+                last_report = time.time()
+            metrics.report(self.metrics_interval, self.metrics_file)
+
+    def store(self, setid, aid, body, error, key=None):
+        """Store the result (and cache it if key is given) or the error of an article"""
+        if error:
+            log.error("Exception on processing article {aid}:\n{error}".format(**locals()))
+            metrics.count("failed")
+            self.failed += 1
+            self.runner.store_failure(aid, error.strip().splitlines()[-1])
+            self.runner.get_progress(setid).add(failed=1)
+            return
+        self.runner.store(aid, body)
+        metrics.count("processed")
+        self.done += 1
+        self.runner.get_progress(setid).add(processed=1)
+        if key is not None:
+            self.runner.cache.set(key, body)
+
+    def lost(self, aids, error):
+        """A batch failed or did not return from the worker: count it, but leave its articles unprocessed"""
+        if isinstance(error, multiprocessing.TimeoutError):
+            error = "no result within {self.timeout} seconds".format(**locals())
+            self.lost_batches += 1
+        else:
+            error = "{}: {}".format(type(error).__name__, error)
+        log.error("Batch of {n} articles failed, leaving them unprocessed: {error}".format(n=len(aids), **locals()))
+        metrics.count("batch_failed")
+
+    def report(self):
+        elapsed = time.time() - self.start
+        rate = self.done / elapsed if elapsed else 0
+        log.info("Processed {self.done} articles ({rate:.2f}/s) with {self.workers} workers, "
+                 "{self.failed} failed".format(**locals()))
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+import unittest
+
+class _TestPlugin(object):
+    """Plugin for the tests, imported by name in the workers"""
+    @classmethod
+    def process_batch(cls, texts):
+        if "boom" in texts:
+            raise OSError("cannot start")
+        if "slow" in texts:
+            time.sleep(60)
+        return [ValueError(t) if t == "fail" else t.upper() for t in texts]
+    @classmethod
+    def serialize(cls, result):
+        return {"text" : result}
+
+class TestParallelRunner(unittest.TestCase):
+    class FakeRunner(object):
+        format = "json"
+        cache = None
+        def __init__(self, batches):
+            self.batches = [[{"_id" : t, "text" : t} for t in batch] for batch in batches]
+            self.stored, self.progress, self.closed = {}, {"processed" : 0, "failed" : 0}, False
+        def get_articles(self, setid, size=1):
+            return self.batches.pop(0) if self.batches else []
+        def get_text(self, article):
+            return article["text"]
+        def get_cached(self, text):
+            return None, None
+        def store(self, aid, body):
+            self.stored[aid] = body
+        def store_failure(self, aid, error):
+            self.stored[aid] = {"error" : error}
+        def get_progress(self, setid):
+            return self
+        def add(self, **counts):
+            for k, v in counts.items():
+                self.progress[k] += v
+        def close(self):
+            self.closed = True
+
+    def test_run(self):
+        runner = self.FakeRunner([["a", "fail"], ["boom"], ["slow"], ["b"]])
+        p = ParallelRunner(runner, "amcatxtas.tools.parallel._TestPlugin", workers=2, timeout=2)
+        p.run(1)
+        self.assertEqual(runner.stored, {"a" : {"text" : "A"}, "b" : {"text" : "B"},
+                                         "fail" : {"error" : "ValueError: fail"}})
+        self.assertEqual(runner.progress, {"processed" : 2, "failed" : 1})
+        self.assertEqual(p.lost_batches, 1) # the slow batch, the failing batch is not lost
+        self.assertEqual((p.done, p.failed), (2, 1)) # articles of failed batches are not counted
+        self.assertTrue(runner.closed)
+        self.assertEqual(multiprocessing.active_children(), []) # the pool is terminated
@@ -0,0 +1,322 @@
+####################################################################################
+#                          The MIT License (MIT)                                   #
+#                                                                                  #
+# Copyright (c) 2014 Wouter van Atteveldt                                          #
+#                                                                                  #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of  #
+# this software and associated documentation files (the "Software"), to deal in    #
+# the Software without restriction, including without limitation the rights to     #
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of #
+# the Software, and to permit persons to whom the Software is furnished to do so,  #
+# subject to the following conditions:                                             #
+#                                                                                  #
+# The above copyright notice and this permission notice shall be included in all   #
+# copies or substantial portions of the Software.                                  #
+#                                                                                  #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR       #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS #
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR   #
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER   #
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN          #
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.       #
+####################################################################################
+
+"""
+Process a set of articles with a pipeline of threaded stages: fetch, normalize, process and index.
+
+The stages are connected by bounded queues, so fetching articles and indexing results overlaps
+with parsing, and a slow stage holds up the stages before it instead of filling up memory.
+The number of threads can be set per stage. The process stage runs the plugin in its threads,
+or, if processes is given, hands each batch to a pool of worker processes (see parallel.py),
+which is better for plugins that do a lot of work in python.
+"""
+
+import Queue
+import signal
+import threading
+import time
+import multiprocessing
+import logging
+log = logging.getLogger(__name__)
+
+from amcatxtas.tools.parallel import process_items, _init_worker, _process
+from amcatxtas.tools.metrics import metrics
+
+_STOP = object()
+
+def _put(queue, item):
+    """Put the item on the queue, waking up regularly so the main thread can handle signals"""
+    while True:
+        try:
+            queue.put(item, timeout=1)
+            return
+        except Queue.Full:
+            pass
+
+class Stage(object):
+    """
+    A number of threads that call function for each item put on the stage.
+    The function returns an iterable of items for the next stage (if any), or None.
+    """
+    def __init__(self, name, function, workers=1, queue_size=4, next=None):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.next = next
+        self.input = Queue.Queue(queue_size)
+        self.threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name="{self.name}-{i}".format(**locals()))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, item):
+        _put(self.input, item)
+
+    def close(self):
+        """Let the threads finish the items on the queue, and wait for them to stop"""
+        for thread in self.threads:
+            self.put(_STOP)
+        for thread in self.threads:
+            while thread.is_alive():
+                thread.join(1)
+
+    def _run(self):
+        while True:
+            item = self.input.get()
+            if item is _STOP:
+                return
+            try:
+                for result in self.function(item) or ():
+                    self.next.put(result)
+            except Exception as e:
+                log.exception("Exception in {self.name} stage".format(**locals()))
+                metrics.fail(self.name, e)
+
+class PipelineRunner(object):
+    """
+    Run the plugin of an NLPRunner over a set using a pipeline of threaded stages.
+    On SIGINT or SIGTERM no new articles are fetched, and the articles in the pipeline
+    are finished and stored before returning. A second signal stops immediately.
+    """
+    def __init__(self, runner, plugin=None, fetchers=1, normalizers=1, processors=1, indexers=1,
+                 processes=None, queue_size=4, report_interval=60, metrics_interval=60, metrics_file=None,
+                 timeout=7200):
+        """
+        Queues hold at most queue_size batches. If processes is given, plugin should be the name
+        of the plugin of the runner (e.g. amcatxtas.plugins.alpino.AlpinoPlugin) and the processors
+        hand their batches to a pool of that many worker processes. Batches that do not return from
+        the pool within timeout seconds (e.g. because the worker died) are left unprocessed.
+        """
+        self.runner = runner
+        self.plugin = plugin
+        self.processes = processes
+        self.timeout = timeout
+        self.report_interval = report_interval
+        self.metrics_interval = metrics_interval
+        self.metrics_file = metrics_file
+        self.pool = None
+        self.stopped = False
+        self.exhausted = False
+        self.done = 0
+        self.failed = 0
+        self.lost_batches = 0
+        self.lock = threading.Lock()
+
+        self.index = Stage("index", self._index, indexers, queue_size)
+        self.process = Stage("process", self._process, processors, queue_size, next=self.index)
+        self.normalize = Stage("normalize", self._normalize, normalizers, queue_size, next=self.process)
+        self.fetch = Stage("fetch", self._fetch, fetchers, queue_size, next=self.normalize)
+        self.stages = [self.fetch, self.normalize, self.process, self.index]
+
+    def stop(self, signum, frame):
+        if self.stopped:
+            raise KeyboardInterrupt()
+        log.warn("Received signal {signum}, finishing articles in progress".format(**locals()))
+        self.stopped = True
+
+    def run(self, setid, size=1, number=None):
+        """Process the set in batches of size articles, until it is done or after number batches"""
+        self.setid, self.size = setid, size
+        # create the queue and progress tracker before the threads need them
+        self.runner.get_queue(setid)
+        self.runner.get_progress(setid)
+        handlers = {s : signal.signal(s, self.stop) for s in (signal.SIGINT, signal.SIGTERM)}
+        if self.processes:
+            self.pool = multiprocessing.Pool(self.processes, _init_worker, (self.plugin, self.runner.format))
+        try:
+            self._run(number)
+            if self.pool and self.lost_batches:
+                self.pool.terminate() # join would wait for the lost batches
+            elif self.pool:
+                self.pool.close()
+        except:
+            if self.pool:
+                self.pool.terminate()
+            raise
+        finally:
+            if self.pool:
+                self.pool.join()
+            for s, handler in handlers.items():
+                signal.signal(s, handler)
+            self.runner.close()
+        self.report()
+        metrics.report(path=self.metrics_file)
+
+    def _run(self, number):
+        for stage in self.stages:
+            stage.start()
+        self.start = last_report = time.time()
+        batches = 0
+        while not (self.stopped or self.exhausted) and (number is None or batches < number):
+            try:
+                self.fetch.input.put(batches, timeout=1)
+                batches += 1
+            except Queue.Full:
+                pass
+            if time.time() - last_report > self.report_interval:
+                self.report()
+                last_report = time.time()
+            metrics.report(self.metrics_interval, self.metrics_file)
+        # close the stages in order, so each stage finishes all items of the stage before it
+        for stage in self.stages:
+            stage.close()
+
+    def _fetch(self, batch):
+        if self.exhausted or self.stopped:
+            return
+        ids = self.runner.get_queue(self.setid).take(self.size)
+        if not ids:
+            self.exhausted = True
+            return
+        articles = self.runner.fetch_articles(self.setid, ids)
+        if articles:
+            yield articles
+
+    def _normalize(self, articles):
+        todo = [] # the uncached articles of the batch are processed together
+        for a in articles:
+            text = self.runner.get_text(a)
+            key, body = self.runner.get_cached(text)
+            if body is not None:
+                self.index.put((a["_id"], None, body, None))
+            else:
+                todo.append((a["_id"], key, text))
+        if todo:
+            yield todo
+
+    def _process(self, todo):
+        keys = {aid : key for (aid, key, text) in todo}
+        items = [(aid, text) for (aid, key, text) in todo]
+        try:
+            if self.pool:
+                output, snapshot = self.pool.apply_async(_process, (items,)).get(self.timeout)
+                metrics.merge(snapshot)
+            else:
+                output = process_items(self.runner.plugin, self.runner.serialize, items)
+        except multiprocessing.TimeoutError:
+            log.error("Batch of {n} articles did not return within {self.timeout} seconds, leaving them unprocessed"
+                      .format(n=len(items), **locals()))
+            metrics.count("batch_failed")
+            with self.lock:
+                self.lost_batches += 1
+            return
+        except Exception:
+            # not a problem of a specific article, so leave them unprocessed instead of storing failures
+            log.exception("Batch of {n} articles failed, leaving them unprocessed".format(n=len(items)))
+            metrics.count("batch_failed")
+            return
+        for aid, body, error in output:
+            yield aid, keys[aid], body, error
+
+    def _index(self, result):
+        aid, key, body, error = result
+        if error:
+            log.error("Exception on processing article {aid}:\n{error}".format(**locals()))
+            metrics.count("failed")
+            self.runner.store_failure(aid, error.strip().splitlines()[-1])
+            self.runner.get_progress(self.setid).add(failed=1)
+            with self.lock:
+                self.failed += 1
+            return
+        if key is not None:
+            self.runner.cache.set(key, body)
+        self.runner.store(aid, body)
+        metrics.count("processed")
+        self.runner.get_progress(self.setid).add(processed=1)
+        with self.lock:
+            self.done += 1
+
+    def report(self):
+        elapsed = time.time() - self.start
+        rate = self.done / elapsed if elapsed else 0
+        queued = ", ".join("{s.name}: {n}".format(s=s, n=s.input.qsize()) for s in self.stages)
+        log.info("Processed {self.done} articles ({rate:.2f}/s), {self.failed} failed, queued: {queued}"
+                 .format(**locals()))
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+import unittest
+
+class TestStage(unittest.TestCase):
+    def test_stages(self):
+        results = []
+        lock = threading.Lock()
+        def collect(x):
+            with lock:
+                results.append(x)
+        last = Stage("collect", collect, workers=2, queue_size=1)
+        first = Stage("double", lambda x: [x, x * 10] if x != 3 else 1/0, workers=3, queue_size=1, next=last)
+        for stage in first, last:
+            stage.start()
+        for i in range(10):
+            first.put(i)
+        for stage in first, last:
+            stage.close()
+        self.assertEqual(sorted(results), sorted([i for i in range(10) if i != 3] + [i * 10 for i in range(10) if i != 3]))
+        self.assertFalse(any(t.is_alive() for t in first.threads + last.threads))
+
+class TestPipelineRunner(unittest.TestCase):
+    class FakeRunner(object):
+        format = "json"
+        cache = None
+        def __init__(self, batches):
+            self.batches = [[{"_id" : t, "text" : t} for t in batch] for batch in batches]
+            self.stored, self.progress, self.closed = {}, {"processed" : 0, "failed" : 0}, False
+        def get_queue(self, setid):
+            return self
+        def take(self, n):
+            return self.batches.pop(0) if self.batches else []
+        def fetch_articles(self, setid, articles):
+            return articles
+        def get_text(self, article):
+            return article["text"]
+        def get_cached(self, text):
+            return None, None
+        def store(self, aid, body):
+            self.stored[aid] = body
+        def store_failure(self, aid, error):
+            self.stored[aid] = {"error" : error}
+        def get_progress(self, setid):
+            return self
+        def add(self, **counts):
+            for k, v in counts.items():
+                self.progress[k] += v
+        def close(self):
+            self.closed = True
+
+    def test_run(self):
+        runner = self.FakeRunner([["a", "fail"], ["boom"], ["slow"], ["b"]])
+        p = PipelineRunner(runner, "amcatxtas.tools.parallel._TestPlugin", processors=2, processes=2, timeout=2)
+        p.run(1)
+        self.assertEqual(runner.stored, {"a" : {"text" : "A"}, "b" : {"text" : "B"},
+                                         "fail" : {"error" : "ValueError: fail"}})
+        self.assertEqual(runner.progress, {"processed" : 2, "failed" : 1})
+        self.assertEqual((p.done, p.failed, p.lost_batches), (2, 1, 1))
+        self.assertTrue(runner.closed)
+        self.assertEqual(multiprocessing.active_children(), []) # the pool is terminated
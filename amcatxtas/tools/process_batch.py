@@ -23,57 +23,142 @@
 
 """
 Process a set of articles and cache the results. Will filter on unprocessed articles
-and work in random order, so can be run in parallel with minimal inefficiency.
+and lease chunks of them before processing, so can be run in parallel without
+processing the same article twice.
 
 It assumes that plugins have .xtas_key, .process(text), and .serialize() properties,
-and that plugin.serialize(plugin.process(text)) returns the value to be cached
+and that plugin.serialize(plugin.process(text)) returns the value to be cached.
+Plugins can also have a .process_batch(texts) method to process all articles of a
+batch as a whole, see process_texts. Plugins that work on tokenized text can declare
+a .tokenizer (a function or its name) and a .process_tokens(token_texts) method, so the
+tokens can be shared with other plugins that use the same tokenizer (see tools.multi).
+
+Articles that cannot be processed are stored with an {"error" : message} document,
+so they are not selected again.
 
 It also assumes (for now) that the 'source' index contains 'headline' and 'text' fields
 """
 
 import re
+import threading
 import logging
 log = logging.getLogger(__name__)
 
-from elasticsearch import Elasticsearch
 from elasticsearch.client import indices
 
+from amcatxtas.tools.bulk import BulkWriter
+from amcatxtas.tools.workqueue import WorkQueue, ESLeaseStore
+from amcatxtas.tools.cache import cache_key, SQLiteCache, ESCache
+from amcatxtas.tools import naf_binary
+from amcatxtas.tools.metrics import metrics
+from amcatxtas.tools.progress import ProgressTracker
+from amcatxtas.tools.esclient import connect, ES_POOL_SIZE
+
 # global settings
 import os
-ES_HOST=os.environ.get("ES_HOST", 'localhost')
-ES_PORT=os.environ.get("ES_PORT", 9200)
 ES_INDEX =os.environ.get('ES_INDEX', 'amcat')
 ES_ARTICLE_DOCTYPE=os.environ.get('ES_ARICLE_DOCTYPE', 'article')
 
+# functions to serialize results in the stored formats, None means plugin.serialize
+FORMATS = {"json" : None,
+           "binary" : naf_binary.serialize}
+
 
 class NLPRunner(object):
-    def __init__(self, plugin):
-        """Create an NLPRunner with the given plugin, which should have .xtas_key and .process(text) properties"""
-        self.es = Elasticsearch(hosts=[{"host":ES_HOST, "port":ES_PORT}])
+    _checked_mappings = set() # (index, doctype) pairs checked by check_mapping in this process
+    _checked_lock = threading.Lock()
+
+    def __init__(self, plugin, leases=None, cache=None, format="json", es=None, corpus_index=None):
+        """
+        Create an NLPRunner with the given plugin, which should have .xtas_key and .process(text) properties
+        leases is the lease store for the work queue, by default leases are stored in elasticsearch
+        cache is an optional cache (see tools.cache) for results of identical texts
+        format is the stored format (see FORMATS), the binary format requires plugins that return a NAF_Article
+        es is the elasticsearch client, by default a client configured by esclient.connect
+        corpus_index is an optional CorpusIndex (see tools.corpus_index) that stored results are added to
+        """
+        self.es = connect() if es is None else es
         self.plugin = plugin
+        self.format = format
         self.check_mapping()
+        self.writer = BulkWriter(self.es, ES_INDEX, self.doctype, on_done=self.indexed)
+        if leases is None:
+            leases = ESLeaseStore(self.es, ES_INDEX, self.doctype + "_lease")
+        self.leases = leases
+        self.queues = {}
+        self.trackers = {}
+        self.cache = cache
+        self.corpus_index = corpus_index
 
     def check_mapping(self):
-        """Check that the mapping for cached results of this plugin exists and create it otherwise"""
-        if not indices.IndicesClient(self.es).exists_type(ES_INDEX, self.doctype):
-            body = {self.doctype : {"_parent" : {"type" : "article"}}}
-            indices.IndicesClient(self.es).put_mapping(ES_INDEX, self.doctype, body=body)
+        """
+        Check that the mapping for cached results of this plugin exists and create it otherwise
+        This is done once per process, as a mapping is not removed during a run
+        """
+        with self._checked_lock:
+            if (ES_INDEX, self.doctype) in self._checked_mappings:
+                return
+            if not indices.IndicesClient(self.es).exists_type(ES_INDEX, self.doctype):
+                body = {self.doctype : {"_parent" : {"type" : "article"},
+                                        "properties" : {"naf_binary" : {"type" : "binary"}}}}
+                indices.IndicesClient(self.es).put_mapping(ES_INDEX, self.doctype, body=body)
+            self._checked_mappings.add((ES_INDEX, self.doctype))
 
     @property
     def doctype(self):
         return "_".join(self.plugin.xtas_key)
 
+    def get_text(self, article):
+        """Return the headline and paragraphs of the article with normalized whitespace"""
+        with metrics.timer("normalize"):
+            headline, text = article['fields']['headline'], article['fields']['text']
+            pars = [headline] + text.split("\n\n")
+            return "\n\n".join(re.sub(r"\s+", " ", t) for t in pars)
+
+    def store(self, aid, body):
+        """Cache the serialized result for the article"""
+        self.writer.add(aid, body, parent=aid)
+        if self.corpus_index is not None:
+            with metrics.timer("corpus_index"):
+                self.corpus_index.add_body(aid, body)
+
+    def indexed(self, aids):
+        """Report the articles whose results were indexed by the bulk writer as done to the work queues"""
+        for queue in self.queues.values():
+            queue.done(aids)
+
     def process_article(self, article):
-        """Process one article and cache (store) the result"""
-        aid = article["_id"]
-        log.info("Parsing {aid}".format(**locals()))
-        headline, text = article['fields']['headline'], article['fields']['text']
-        pars = [headline] + text.split("\n\n")
-        text = "\n\n".join(re.sub(r"\s+", " ", t) for t in pars)
-        
-        p = self.plugin.process(text)
-        body = self.plugin.serialize(p)
-        self.es.index(index=ES_INDEX, doc_type=self.doctype, id=aid, body=body, parent=aid)
+        """Process one article and cache (store) the result, see process"""
+        self.process([article])
+
+    def store_failure(self, aid, error):
+        """Store an error document for an article that could not be processed, so it is not selected again"""
+        self.store(aid, {"error" : error})
+
+    def store_result(self, aid, key, result):
+        """Serialize, cache (if key is not None) and store the plugin result for an article"""
+        with metrics.timer("serialize"):
+            body = self.serialize(result)
+        if key is not None:
+            self.cache.set(key, body)
+        self.store(aid, body)
+
+    def serialize(self, result):
+        """Serialize the plugin result in the stored format"""
+        serialize = FORMATS[self.format] or self.plugin.serialize
+        return serialize(result)
+
+    def get_cached(self, text):
+        """Return the cache key and cached result (or None) for the text, or None, None if there is no cache"""
+        if self.cache is None:
+            return None, None
+        key = cache_key(text, self.plugin, self.format)
+        with metrics.timer("cache"):
+            body = self.cache.get(key)
+        if body is not None:
+            log.debug("Using cached result {key}".format(**locals()))
+        metrics.count("cache_miss" if body is None else "cache_hit")
+        return key, body
 
     def get_filter(self, setid):
         """Create a DSL filter dict to filter on set and no existing parser"""
@@ -81,35 +166,155 @@ class NLPRunner(object):
                                              "query" : {"match_all" : {}}}}}
         return {"bool" : {"must" : [{"term" : {"sets" : setid}}, noparse]}}
         
+    def get_queue(self, setid):
+        """Return the work queue of unprocessed articles for this set"""
+        if setid not in self.queues:
+            prefix = "{setid}_{self.doctype}".format(**locals())
+            self.queues[setid] = WorkQueue(self.es, ES_INDEX, ES_ARTICLE_DOCTYPE, self.get_filter(setid),
+                                           self.leases, prefix)
+        return self.queues[setid]
+
+    def get_progress(self, setid):
+        """Return the progress tracker for this set"""
+        if setid not in self.trackers:
+            self.trackers[setid] = ProgressTracker(self.es, ES_INDEX, self.doctype + "_progress", setid,
+                                                   lambda: self.progress(setid))
+        return self.trackers[setid]
+
     def get_articles(self, setid, size=1):
-        """Return one or more ranbom uncached articles from the set"""
-        body = {"query" : {"function_score" : {"filter" : self.get_filter(setid), "random_score" : {}}}}
-        result = self.es.search(index=ES_INDEX, doc_type=ES_ARTICLE_DOCTYPE, body=body, fields=["headline", "text"], size=size)
+        """Return one or more uncached articles from the chunks leased from the set"""
+        queue = self.get_queue(setid)
+        while True:
+            ids = queue.take(size)
+            if not ids:
+                return []
+            articles = self.fetch_articles(setid, ids)
+            if articles:
+                return articles
+
+    def fetch_articles(self, setid, ids):
+        """Return the articles with the given ids that are (still) unprocessed"""
+        with metrics.timer("fetch"):
+            # check again, the ids were enumerated at the start of the run
+            body = {"query" : {"filtered" : {"filter" : {"bool" : {"must" : [
+                {"ids" : {"values" : ids}}, self.get_filter(setid)]}}}}}
+            result = self.es.search(index=ES_INDEX, doc_type=ES_ARTICLE_DOCTYPE, body=body, fields=["headline", "text"], size=len(ids))
+            metrics.count("fetched", len(result['hits']['hits']))
+        # articles that were processed in the mean time are done
+        self.get_queue(setid).done(set(ids) - {int(hit['_id']) for hit in result['hits']['hits']})
         return result['hits']['hits']
 
     def process_articles(self, setid, size=1):
-        """Process one or more random uncached articles from the given set"""
-        articles = list(self.get_articles(setid, size=size))
+        """Process one or more uncached articles from the given set"""
+        articles = self.get_articles(setid, size=size)
         if not articles:
             return True # done!
-            
-        for a in self.get_articles(setid, size=size):
+        processed, failed = self.process(articles)
+        self.get_progress(setid).add(processed=processed, failed=failed)
+
+    def process(self, articles):
+        """
+        Process the articles (as one batch) and cache (store) the results.
+        Returns the number of processed and failed articles, articles that could not be processed because
+        the whole batch failed are not counted (nor stored as failed), so they are processed again later.
+        """
+        todo = [] # article, cache key, text
+        processed, failed = 0, 0
+        for a in articles:
+            text = self.get_text(a)
+            key, body = self.get_cached(text)
+            if body is None:
+                todo.append((a, key, text))
+            else:
+                self.store(a["_id"], body)
+                metrics.count("processed")
+                processed += 1
+
+        try:
+            with metrics.timer("process", items=len(todo)) as t:
+                results = process_texts(self.plugin, [text for (a, key, text) in todo])
+                t["tokens"] = sum(len(getattr(r, "words", ())) for r in results)
+        except Exception:
+            # not a problem of a specific article (e.g. the parser could not be started), so leave them unprocessed
+            log.exception("Exception on processing a batch of {n} articles".format(n=len(todo)))
+            metrics.count("batch_failed")
+            return processed, failed
+        for (a, key, text), result in zip(todo, results):
             try:
-                self.process_article(a)
-            except:
+                if isinstance(result, Exception):
+                    raise result
+                self.store_result(a["_id"], key, result)
+                metrics.count("processed")
+                processed += 1
+            except Exception as e:
                 log.exception("Exception on processing article {aid}".format(aid=a.get("_id")))
+                metrics.fail("article", e)
+                self.store_failure(a["_id"], "{}: {}".format(type(e).__name__, e))
+                failed += 1
+        return processed, failed
+
+    def close(self):
+        """Index any remaining buffered results and release the leases of finished chunks"""
+        self.writer.close()
+        for queue in self.queues.values():
+            queue.release_all()
+        for tracker in self.trackers.values():
+            tracker.flush()
+        if self.corpus_index is not None:
+            self.corpus_index.flush()
 
     def progress(self, setid):
-        """Return a todo, total pair to indicate how many articles exist without result / in total"""
+        """
+        Return a todo, total pair to indicate how many articles exist without result / in total
+        This is slow on big sets, see get_progress for a faster estimate
+        """
         body = {"filter" : self.get_filter(setid)}
         result = self.es.search(index=ES_INDEX, doc_type=ES_ARTICLE_DOCTYPE, body=body, size=0)
         todo = result['hits']['total']
-        print body
         body = {"filter" : {"term" : {"sets" : setid}}}
         result = self.es.search(index=ES_INDEX, doc_type=ES_ARTICLE_DOCTYPE, body=body, size=0)
         total = result['hits']['total']
         return todo, total
             
+def tokenize_texts(tokenizer, texts):
+    """
+    Tokenize the texts with the tokenizer (a function or its name), returning the tokens or the exception for each text.
+    An EnvironmentError (e.g. the tokenizer could not be started) is raised, as it is not a problem of a specific text.
+    """
+    if isinstance(tokenizer, basestring):
+        tokenizer = import_attribute(tokenizer)
+    results = []
+    for text in texts:
+        try:
+            results.append(tokenizer(text))
+        except EnvironmentError:
+            raise
+        except Exception as e:
+            results.append(e)
+    return results
+
+def process_texts(plugin, texts, tokens=None):
+    """
+    Process the texts with the plugin, returning the result or the exception for each text.
+    If the plugin has a process_batch method the texts are passed to it together, so it can
+    divide the work over the texts as it sees fit.
+    If tokens is given (the output of tokenize_texts with the tokenizer of the plugin), the
+    texts that could be tokenized are passed to its process_tokens method instead.
+    """
+    if tokens is not None:
+        ok = [t for t in tokens if not isinstance(t, Exception)]
+        results = iter(plugin.process_tokens(ok) if ok else [])
+        return [t if isinstance(t, Exception) else next(results) for t in tokens]
+    if hasattr(plugin, "process_batch"):
+        return plugin.process_batch(texts)
+    results = []
+    for text in texts:
+        try:
+            results.append(plugin.process(text))
+        except Exception as e:
+            results.append(e)
+    return results
+
 def import_attribute(module, attribute=None):
     """
     Import and return the attribute from the module
@@ -132,23 +337,80 @@ if __name__ == '__main__':
     
     import argparse
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument('--progress', action='store_const', const=True)
+    parser.add_argument('--progress', action='store_const', const=True,
+                        help="Show the progress on the set, with exact counts if the last count is over an hour old")
+    parser.add_argument('--exact', action='store_true', help="With --progress, always count exactly")
     parser.add_argument('--number', '-n', default=1, type=int)
     parser.add_argument('--size', '-s', default=1, type=int)
-    parser.add_argument('plugin')
+    parser.add_argument('--workers', '-w', type=int, help="Process articles with a pool of WORKERS processes")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="Fetch, normalize, process and index in parallel threads (see pipeline.py)")
+    parser.add_argument('--fetchers', type=int, default=1, help="Number of fetch threads in the pipeline")
+    parser.add_argument('--normalizers', type=int, default=1, help="Number of normalize threads in the pipeline")
+    parser.add_argument('--processors', type=int, help="Number of process threads in the pipeline "
+                        "(default: WORKERS if given, otherwise 1)")
+    parser.add_argument('--indexers', type=int, default=1, help="Number of index threads in the pipeline")
+    parser.add_argument('--queue-size', type=int, default=4, help="Maximum number of batches waiting for a pipeline stage")
+    parser.add_argument('--format', choices=sorted(FORMATS), default="json", help="Format of the stored results")
+    parser.add_argument('--cache', help="Cache results of identical texts in this sqlite file")
+    parser.add_argument('--es-cache', help="Cache results of identical texts in this elasticsearch index")
+    parser.add_argument('--corpus-index', help="Add the dependencies of stored results (of the first plugin) "
+                        "to the corpus index in this directory")
+    parser.add_argument('--metrics-interval', default=60, type=int, help="Log a metrics summary every N seconds")
+    parser.add_argument('--metrics-file', help="Write metrics in Prometheus text format to this file")
+    parser.add_argument('--metrics-port', type=int, help="Serve metrics in Prometheus text format on this port")
+    parser.add_argument('plugin', nargs="+", help="Plugin to run, e.g. amcatxtas.plugins.alpino.AlpinoPlugin. "
+                        "Multiple plugins are run in a single pass (see multi.py)")
     parser.add_argument('articleset', type=int)
     args = parser.parse_args()
+    if len(args.plugin) > 1 and (args.workers or args.pipeline):
+        parser.error("--workers and --pipeline can only be used with a single plugin")
 
-    plugin = import_attribute(args.plugin)
+    plugins = [import_attribute(plugin) for plugin in args.plugin]
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
     
-    n = NLPRunner(plugin)
+    # make sure every thread that uses elasticsearch can have its own connection
+    threads = args.fetchers + args.normalizers + (args.processors or args.workers or 1) + args.indexers
+    es = connect(pool_size=max(ES_POOL_SIZE, threads + 1))
+    if len(plugins) > 1:
+        from amcatxtas.tools.multi import MultiRunner
+        n = MultiRunner.create(plugins, format=args.format, es=es)
+        runners = n.runners
+    else:
+        n = NLPRunner(plugins[0], format=args.format, es=es)
+        runners = [n]
+    # one cache can be shared, as the cache keys include the plugin
+    cache = SQLiteCache(args.cache) if args.cache else ESCache(es, args.es_cache) if args.es_cache else None
+    for runner in runners:
+        runner.cache = cache
+    if args.corpus_index:
+        from amcatxtas.tools.corpus_index import CorpusIndex
+        runners[0].corpus_index = CorpusIndex(args.corpus_index) # results of other plugins are not parses
     if args.progress:
-        todo, total = n.progress(args.articleset)
-        print "Todo: {todo} out of {total} articles in set {args.articleset} for plugin {args.plugin}".format(**locals())
+        for plugin, runner in zip(args.plugin, runners):
+            tracker = runner.get_progress(args.articleset)
+            status = tracker.status(tracker.reconcile() if args.exact else None)
+            print "{progress} for plugin {plugin}".format(progress=tracker.format(status), **locals())
+    elif args.pipeline:
+        from amcatxtas.tools.pipeline import PipelineRunner
+        p = PipelineRunner(n, args.plugin[0], args.fetchers, args.normalizers, args.processors or args.workers or 1,
+                           args.indexers, processes=args.workers, queue_size=args.queue_size,
+                           metrics_interval=args.metrics_interval, metrics_file=args.metrics_file)
+        p.run(args.articleset, size=args.size, number=args.number)
+    elif args.workers:
+        from amcatxtas.tools.parallel import ParallelRunner
+        p = ParallelRunner(n, args.plugin[0], args.workers, metrics_interval=args.metrics_interval, metrics_file=args.metrics_file)
+        p.run(args.articleset, size=args.size, number=args.number)
     else:
-        for i in range(args.number):
-            log.info("Processing batch {i} / {args.number}".format(**locals()))
-            done = n.process_articles(args.articleset, size=args.size)
-            if done:
-                log.info("Done")
-                break
+        try:
+            for i in range(args.number):
+                log.info("Processing batch {i} / {args.number}".format(**locals()))
+                done = n.process_articles(args.articleset, size=args.size)
+                metrics.report(args.metrics_interval, args.metrics_file)
+                if done:
+                    log.info("Done")
+                    break
+        finally:
+            n.close()
+            metrics.report(path=args.metrics_file)
@@ -0,0 +1,209 @@
+####################################################################################
+#                          The MIT License (MIT)                                   #
+#                                                                                  #
+# Copyright (c) 2014 Wouter van Atteveldt                                          #
+#                                                                                  #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of  #
+# this software and associated documentation files (the "Software"), to deal in    #
+# the Software without restriction, including without limitation the rights to     #
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of #
+# the Software, and to permit persons to whom the Software is furnished to do so,  #
+# subject to the following conditions:                                             #
+#                                                                                  #
+# The above copyright notice and this permission notice shall be included in all   #
+# copies or substantial portions of the Software.                                  #
+#                                                                                  #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR       #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS #
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR   #
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER   #
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN          #
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.       #
+####################################################################################
+
+"""
+Incremental progress tracking of a plugin on an article set.
+
+Counting the unprocessed articles of a set needs a has_child query over the whole set, which is
+too slow on big sets to run often. Instead, runners add the number of articles they processed
+and failed to a shared progress document per set and plugin, and the counts in that document are
+only replaced by exact counts every once in a while (or on request).
+"""
+
+import time
+import threading
+import datetime
+import logging
+log = logging.getLogger(__name__)
+
+from elasticsearch.exceptions import ConflictError, NotFoundError
+
+class ProgressTracker(object):
+    """
+    Track the progress on a set. Processed and failed articles are added with add(), and added to
+    the progress document (with id setid) every flush_interval seconds, using its version so
+    concurrent runners do not overwrite each others counts. If the exact counts in the document
+    are older than reconcile_interval seconds they are recounted using count(), which should return
+    a (todo, total) pair. The last history_size (time, done) samples are kept to compute the rate.
+    """
+    def __init__(self, es, index, doc_type, setid, count, flush_interval=30, reconcile_interval=3600,
+                 history_size=20):
+        self.es = es
+        self.index = index
+        self.doc_type = doc_type
+        self.setid = setid
+        self.count = count
+        self.flush_interval = flush_interval
+        self.reconcile_interval = reconcile_interval
+        self.history_size = history_size
+        self.lock = threading.Lock()
+        self.processed = 0 # not yet flushed
+        self.failed = 0
+        self.last_flush = time.time()
+
+    def add(self, processed=0, failed=0):
+        """Add processed and failed articles, flushing if flush_interval has passed"""
+        with self.lock:
+            self.processed += processed
+            self.failed += failed
+            flush = time.time() - self.last_flush >= self.flush_interval
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """
+        Add the processed and failed articles to the progress document, and log the status.
+        Errors are logged and the counts are kept for the next flush, as progress is not worth failing a run for.
+        """
+        with self.lock:
+            processed, failed, self.processed, self.failed = self.processed, self.failed, 0, 0
+            self.last_flush = time.time()
+        def update(doc):
+            doc["done"] += processed + failed
+            doc["failed"] += failed
+        try:
+            doc = self._update(update)
+        except Exception:
+            log.warn("Could not update progress of set {self.setid}".format(**locals()), exc_info=True)
+            with self.lock:
+                self.processed += processed
+                self.failed += failed
+            return None
+        log.info(self.format(self.status(doc)))
+        return doc
+
+    def reconcile(self):
+        """Replace the counts in the progress document by exact counts"""
+        todo, total = self.count()
+        now = time.time()
+        def update(doc):
+            doc.update(total=total, done=total - todo, reconciled=now)
+        return self._update(update, counts=(todo, total))
+
+    def get(self):
+        """Return the progress document, reconciling it if it is missing or too old"""
+        doc = self._get()[0]
+        if doc is None or time.time() - doc["reconciled"] > self.reconcile_interval:
+            doc = self.reconcile()
+        return doc
+
+    def status(self, doc=None):
+        """Return a dict with total, done, failed and remaining articles, the rate (articles/s) and eta (s)"""
+        if doc is None:
+            doc = self.get()
+        status = {k : doc[k] for k in ("total", "done", "failed")}
+        status["remaining"] = max(0, doc["total"] - doc["done"])
+        status["rate"] = status["eta"] = None
+        history = doc["history"]
+        if len(history) > 1 and history[-1]["time"] > history[0]["time"]:
+            rate = float(history[-1]["done"] - history[0]["done"]) / (history[-1]["time"] - history[0]["time"])
+            if rate > 0:
+                status["rate"] = rate
+                status["eta"] = status["remaining"] / rate
+        return status
+
+    def format(self, status):
+        s = "Set {self.setid}: {done} / {total} done ({failed} failed), {remaining} remaining".format(self=self, **status)
+        if status["rate"]:
+            eta = datetime.timedelta(seconds=int(status["eta"]))
+            s += ", {rate:.2f} articles/s, eta {eta}".format(rate=status["rate"], eta=eta)
+        return s
+
+    def _get(self):
+        """Return the progress document and its version, or None, None if it does not exist"""
+        try:
+            result = self.es.get(index=self.index, doc_type=self.doc_type, id=self.setid)
+        except NotFoundError:
+            return None, None
+        return result['_source'], result['_version']
+
+    def _update(self, update, counts=None):
+        """
+        Apply update to the progress document (or create it from the exact counts,
+        using counts if given), retrying if it was changed by another runner
+        """
+        while True:
+            doc, version = self._get()
+            if doc is None:
+                # the exact counts include everything that was stored up to now
+                todo, total = counts or self.count()
+                doc = {"total" : total, "done" : total - todo, "failed" : 0, "reconciled" : time.time(), "history" : []}
+            else:
+                update(doc)
+            doc["history"] = (doc["history"] + [{"time" : time.time(), "done" : doc["done"]}])[-self.history_size:]
+            try:
+                if version is None:
+                    self.es.create(index=self.index, doc_type=self.doc_type, id=self.setid, body=doc)
+                else:
+                    self.es.index(index=self.index, doc_type=self.doc_type, id=self.setid, body=doc, version=version)
+                return doc
+            except ConflictError:
+                log.debug("Progress document changed by another runner, retrying")
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+import unittest
+
+class TestProgressTracker(unittest.TestCase):
+    class FakeES(object):
+        """Stores documents with versions, like elasticsearch"""
+        def __init__(self):
+            self.docs = {}
+        def get(self, index, doc_type, id):
+            if id not in self.docs:
+                raise NotFoundError(404, "not found")
+            version, doc = self.docs[id]
+            return {"_source" : dict(doc), "_version" : version}
+        def create(self, index, doc_type, id, body):
+            if id in self.docs:
+                raise ConflictError(409, "exists")
+            self.docs[id] = (1, dict(body))
+        def index(self, index, doc_type, id, body, version):
+            if self.docs[id][0] != version:
+                raise ConflictError(409, "version conflict")
+            self.docs[id] = (version + 1, dict(body))
+
+    def test_progress(self):
+        es = self.FakeES()
+        counts = []
+        def count():
+            counts.append(1)
+            return 80, 100
+        t = ProgressTracker(es, "index", "progress", 1, count, flush_interval=3600)
+        t2 = ProgressTracker(es, "index", "progress", 1, count, flush_interval=3600)
+        self.assertEqual(t.status()["remaining"], 80)
+        t.add(processed=5, failed=1)
+        t2.add(processed=4)
+        self.assertEqual(t.status()["remaining"], 80) # not flushed yet
+        t.flush()
+        t2.flush()
+        status = t.status()
+        self.assertEqual((status["done"], status["failed"], status["remaining"]), (30, 1, 70))
+        self.assertEqual(len(counts), 1)
+        self.assertTrue(status["rate"] is None or status["rate"] > 0)
+        # reconcile resets the counts to the exact counts
+        self.assertEqual(t.reconcile()["done"], 20)
+        self.assertEqual(len(counts), 2)
+        self.assertIn("20 / 100 done", t.format(t.status()))
@@ -0,0 +1,298 @@
+####################################################################################
+#                          The MIT License (MIT)                                   #
+#                                                                                  #
+# Copyright (c) 2014 Wouter van Atteveldt                                          #
+#                                                                                  #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of  #
+# this software and associated documentation files (the "Software"), to deal in    #
+# the Software without restriction, including without limitation the rights to     #
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of #
+# the Software, and to permit persons to whom the Software is furnished to do so,  #
+# subject to the following conditions:                                             #
+#                                                                                  #
+# The above copyright notice and this permission notice shall be included in all   #
+# copies or substantial portions of the Software.                                  #
+#                                                                                  #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR       #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS #
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR   #
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER   #
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN          #
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.       #
+####################################################################################
+
+"""
+Claim-based work queue for processing the articles in a set with parallel runners.
+
+The unprocessed article ids of a set are enumerated once with a scan, and grouped
+into chunks by id range (id // chunk_width), so all runners agree on the chunks
+regardless of when they enumerated them. A runner leases a chunk before it hands
+out its ids, so parallel runners do not process the same articles. The lease is
+renewed whenever ids are handed out, and released when all ids of the chunk have
+been handed out and reported done (i.e. their results were indexed).
+"""
+
+import random
+import threading
+import time
+import logging
+log = logging.getLogger(__name__)
+
+from elasticsearch import helpers
+from elasticsearch.exceptions import ConflictError, NotFoundError
+
+class LocalLeaseStore(object):
+    """In-process lease store, for a single runner or for testing"""
+    def __init__(self):
+        self.leases = {} # key : expiry time
+        self.lock = threading.Lock()
+
+    def acquire(self, key, ttl):
+        with self.lock:
+            now = time.time()
+            if self.leases.get(key, 0) > now:
+                return False
+            self.leases[key] = now + ttl
+            return True
+
+    def renew(self, key, ttl):
+        with self.lock:
+            self.leases[key] = time.time() + ttl
+            return True
+
+    def release(self, key):
+        with self.lock:
+            self.leases.pop(key, None)
+
+class ESLeaseStore(object):
+    """
+    Store leases as small documents in elasticsearch. A lease is acquired by creating
+    the document, or by overwriting an expired lease using its version, so concurrent
+    runners cannot both acquire it. Expiry uses the local clock of the runners.
+    A lease is renewed using the version it was acquired (or last renewed) with, so a lease
+    that expired and was taken over by another runner is not renewed.
+    """
+    def __init__(self, es, index, doc_type):
+        self.es = es
+        self.index = index
+        self.doc_type = doc_type
+        self.versions = {} # key : version of our lease document
+
+    def acquire(self, key, ttl):
+        body = {"expires" : time.time() + ttl}
+        try:
+            result = self.es.create(index=self.index, doc_type=self.doc_type, id=key, body=body)
+            self.versions[key] = result['_version']
+            return True
+        except ConflictError:
+            pass
+        try:
+            lease = self.es.get(index=self.index, doc_type=self.doc_type, id=key)
+        except NotFoundError:
+            return False # released in the mean time, leave it to the next try
+        if lease['_source']['expires'] > time.time():
+            return False
+        try:
+            result = self.es.index(index=self.index, doc_type=self.doc_type, id=key, body=body, version=lease['_version'])
+            self.versions[key] = result['_version']
+            return True
+        except ConflictError:
+            return False
+
+    def renew(self, key, ttl):
+        """Extend our lease, returning False if it was lost"""
+        if key not in self.versions:
+            return False
+        body = {"expires" : time.time() + ttl}
+        try:
+            result = self.es.index(index=self.index, doc_type=self.doc_type, id=key, body=body,
+                                   version=self.versions[key])
+        except (ConflictError, NotFoundError):
+            self.versions.pop(key, None)
+            return False
+        self.versions[key] = result['_version']
+        return True
+
+    def release(self, key):
+        """Delete our lease, unless it was taken over by another runner in the mean time"""
+        if key not in self.versions:
+            return
+        try:
+            self.es.delete(index=self.index, doc_type=self.doc_type, id=key, version=self.versions.pop(key))
+        except (ConflictError, NotFoundError):
+            pass
+
+class WorkQueue(object):
+    """
+    Hand out unprocessed article ids from leased chunks. The ids are enumerated on first use.
+    Leases are renewed on every take, and released when all ids of the chunk are handed out and
+    reported with done, or by release_all (on closing the runner), or when they expire.
+    Ids can be taken and reported done from different threads.
+    """
+    def __init__(self, es, index, doc_type, filter, store, prefix, chunk_width=1000, ttl=3600):
+        self.es = es
+        self.index = index
+        self.doc_type = doc_type
+        self.filter = filter
+        self.store = store
+        self.prefix = prefix
+        self.chunk_width = chunk_width
+        self.ttl = ttl
+        self.chunks = None # chunk : [ids], filled on first use
+        self.leased = []
+        self.ids = []
+        self.pending = {} # lease key : set of handed out ids that are not done
+        self.lock = threading.Lock()
+
+    def scan_ids(self):
+        """Enumerate the ids of all documents matching the filter"""
+        body = {"query" : {"filtered" : {"filter" : self.filter}}}
+        for hit in helpers.scan(self.es, query=body, index=self.index, doc_type=self.doc_type, fields=[]):
+            yield int(hit['_id'])
+
+    def enumerate(self):
+        self.chunks = {}
+        for id in self.scan_ids():
+            self.chunks.setdefault(id // self.chunk_width, []).append(id)
+        log.info("Found {n} unprocessed articles in {m} chunks".format(
+            n=sum(len(ids) for ids in self.chunks.values()), m=len(self.chunks)))
+        # visit chunks in random order to minimize contention between runners
+        self.order = list(self.chunks)
+        random.shuffle(self.order)
+
+    def lease(self):
+        """Lease the next free chunk and return its ids, or None if no free chunk is left"""
+        if self.chunks is None:
+            self.enumerate()
+        while self.order:
+            chunk = self.order.pop()
+            key = self.key(chunk)
+            if self.store.acquire(key, self.ttl):
+                self.leased.append(key)
+                return sorted(self.chunks.pop(chunk))
+        return None
+
+    def key(self, chunk):
+        return "{self.prefix}_{chunk}".format(**locals())
+
+    def take(self, n):
+        """
+        Return up to n ids, leasing new chunks as needed. Returns an empty list if done.
+        The leases of the chunks that are held are renewed first, and the ids of chunks
+        whose lease was lost are dropped, as another runner may be processing them.
+        """
+        with self.lock:
+            lost = {key for key in self.leased if not self.store.renew(key, self.ttl)}
+            if lost:
+                log.warn("Lost the lease on {}, skipping their remaining ids".format(", ".join(sorted(lost))))
+                self.ids = [id for id in self.ids if self.key(id // self.chunk_width) not in lost]
+                self.leased = [key for key in self.leased if key not in lost]
+                for key in lost:
+                    self.pending.pop(key, None)
+            while len(self.ids) < n:
+                ids = self.lease()
+                if ids is None:
+                    break
+                self.ids += ids
+            result, self.ids = self.ids[:n], self.ids[n:]
+            for id in result:
+                self.pending.setdefault(self.key(id // self.chunk_width), set()).add(id)
+            self._release(pending=False)
+            return result
+
+    def done(self, ids):
+        """Report that the given ids (if handed out by this queue) are done, releasing drained chunks"""
+        with self.lock:
+            for id in ids:
+                self.pending.get(self.key(int(id) // self.chunk_width), set()).discard(int(id))
+            self._release(pending=False)
+
+    def release_all(self):
+        """Release all leases whose ids have been handed out"""
+        with self.lock:
+            self._release(pending=True)
+
+    def _release(self, pending):
+        """Release the leases of chunks without ids left to hand out and, unless pending is True, without pending ids"""
+        keep = {self.key(id // self.chunk_width) for id in self.ids}
+        if not pending:
+            keep |= {key for (key, ids) in self.pending.items() if ids}
+        for key in self.leased:
+            if key not in keep:
+                self.store.release(key)
+                self.pending.pop(key, None)
+        self.leased = [key for key in self.leased if key in keep]
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+import unittest
+
+class TestWorkQueue(unittest.TestCase):
+    class FixedQueue(WorkQueue):
+        def __init__(self, ids, store):
+            super(TestWorkQueue.FixedQueue, self).__init__(None, None, None, None, store, "test", chunk_width=10)
+            self.fixed_ids = ids
+        def scan_ids(self):
+            return iter(self.fixed_ids)
+
+    def test_disjoint(self):
+        store = LocalLeaseStore()
+        ids = [1, 3, 5, 12, 14, 25, 31]
+        q1, q2 = self.FixedQueue(ids, store), self.FixedQueue(ids, store)
+        taken1, taken2 = [], []
+        while True:
+            a, b = q1.take(2), q2.take(2)
+            if not (a or b):
+                break
+            taken1 += a
+            taken2 += b
+        self.assertEqual(sorted(taken1 + taken2), ids)
+        self.assertFalse(set(taken1) & set(taken2))
+
+    def test_release(self):
+        store = LocalLeaseStore()
+        q = self.FixedQueue([1, 3], store)
+        self.assertEqual(len(q.take(1)), 1)
+        self.assertEqual(len(store.leases), 1)
+        q.release_all()
+        self.assertEqual(len(store.leases), 1) # still has ids to hand out
+        q.take(1)
+        q.release_all()
+        self.assertEqual(len(store.leases), 0)
+
+    def test_done(self):
+        store = LocalLeaseStore()
+        q = self.FixedQueue([1, 3], store)
+        self.assertEqual(q.take(2), [1, 3])
+        q.done([1])
+        self.assertEqual(len(store.leases), 1)
+        q.done([1, 5]) # reporting twice or reporting ids of other queues has no effect
+        self.assertEqual(len(store.leases), 1)
+        q.done(["3"]) # runners report the ids of the es hits
+        self.assertEqual(len(store.leases), 0) # drained and done
+
+    def test_renew(self):
+        store = LocalLeaseStore()
+        q = self.FixedQueue([1, 2, 3], store)
+        q.ttl = 0.01
+        q.take(1)
+        time.sleep(0.02)
+        q.ttl = 3600
+        q.take(1) # renews the expired lease, which no other runner took
+        self.assertFalse(store.acquire("test_0", 10))
+
+    def test_lost(self):
+        class LosingStore(LocalLeaseStore):
+            def renew(self, key, ttl):
+                return False # taken over by another runner
+        store = LosingStore()
+        q = self.FixedQueue([1, 2, 3, 12, 14], store)
+        first = q.take(1)
+        rest = q.take(5)
+        self.assertTrue(rest)
+        self.assertFalse({id // 10 for id in rest} & {first[0] // 10})
+        self.assertIn(q.key(first[0] // 10), store.leases) # not released, it is no longer ours
+        q.done(first)
+        self.assertIn(q.key(first[0] // 10), store.leases)